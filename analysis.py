@@ -0,0 +1,154 @@
+"""
+Analysis pipelines behind the /process_image and /process_dal routes.
+
+Each pipeline takes a BGR image, plus an optional progress(stage, **info)
+callback, and returns the overlay image together with the JSON-ready result
+dictionary. With vector=True the overlay is a JSON-ready vector overlay (see
+vector_overlay.py) instead of an image, so the routes and the job workers report results in the same shape.
+`aggregate_results` summarises many results of one pipeline for batch grading.
+"""
+
+
+def analyze_rice(image, progress=None, vector=False):
+    """Run the rice pipeline and return (overlay, result dict)."""
+    from process_image import detect_and_count_rice_grains
+    processed_result = detect_and_count_rice_grains(image, progress=progress, vector=vector)
+
+    # Unpack results from the new function (7 values)
+    final_image = processed_result[0]
+    full_grain_count = processed_result[1]
+    broken_grain_count = processed_result[2]
+    chalky_count = processed_result[3]
+    black_count = processed_result[4]
+    yellow_count = processed_result[5]
+    broken_percentages = processed_result[6]
+
+    # Set default values for stone and husk since new version doesn't detect them
+    stone_count = 0
+    husk_count = 0
+    brown_count = 0  # Also not detected in new version
+
+    # Calculate total count
+    total_objects = full_grain_count + chalky_count + black_count + yellow_count + brown_count + broken_grain_count + stone_count + husk_count
+
+    return final_image, {
+        "total_objects": total_objects,
+        "full_grain_count": full_grain_count,
+        "chalky_count": chalky_count,
+        "black_count": black_count,
+        "yellow_count": yellow_count,
+        "brown_count": brown_count,
+        "broken_percentages": broken_percentages,
+        "broken_grain_count": broken_grain_count,
+        "stone_count": stone_count,
+        "husk_count": husk_count
+    }
+
+
+def analyze_dal(image, progress=None, vector=False):
+    """Run the dal pipeline and return (overlay, result dict)."""
+    from procress_dal import process_dal
+    full_grain_count, broken_grain_count, broken_percent, visualization_image, black_dal = process_dal(
+        image, progress=progress, display_width=None, vector=vector)  # The overlay writer applies the size limit
+
+    return visualization_image, {
+        "full_grain_count": full_grain_count,
+        "broken_grain_count": broken_grain_count,
+        "broken_percent": broken_percent,
+        "black_dal": black_dal  # Fixed: changed from black_dal_count to black_dal
+    }
+
+
+PIPELINES = {
+    "rice": analyze_rice,
+    "dal": analyze_dal,
+}
+
+# Overlay outputs: an encoded image served from /processed, or per-grain geometry
+OVERLAY_MODES = ("image", "vector")
+
+# Prefix of the overlay image written for each pipeline
+OVERLAY_PREFIXES = {
+    "rice": "processed",
+    "dal": "processed_dal",
+}
+
+# Result field -> grain class, per pipeline
+GRAIN_CLASSES = {
+    "rice": {
+        "full_grain_count": "full",
+        "broken_grain_count": "broken",
+        "chalky_count": "chalky",
+        "black_count": "black",
+        "yellow_count": "yellow",
+        "brown_count": "brown",
+    },
+    "dal": {
+        "full_grain_count": "full",
+        "broken_grain_count": "broken",
+        "black_dal": "black",
+    },
+}
+
+
+def total_count(grain_type, result):
+    """Total grains in one result; dal results carry no total_objects."""
+    if grain_type == "dal":
+        return result.get("full_grain_count", 0) + result.get("broken_grain_count", 0)
+    return result.get("total_objects", 0)
+
+
+def _spread(values):
+    if not values:
+        return {"min": 0, "max": 0, "mean": 0, "stdev": 0}
+    mean = sum(values) / len(values)
+    variance = sum((value - mean) ** 2 for value in values) / len(values)
+    return {
+        "min": round(min(values), 2),
+        "max": round(max(values), 2),
+        "mean": round(mean, 2),
+        "stdev": round(variance ** 0.5, 2),
+    }
+
+
+def aggregate_results(grain_type, results):
+    """
+    Lot-level statistics over the per-image results of one pipeline.
+
+    Returns summed counts, the summed broken-size breakdown, the spread of the
+    per-image broken percentage and the lot's defect ratios.
+    """
+    count_fields = [key for key, value in (results[0] if results else {}).items()
+                    if isinstance(value, (int, float))]
+    totals = {field: sum(result.get(field, 0) for result in results) for field in count_fields}
+    total = sum(total_count(grain_type, result) for result in results)
+    totals["total_objects"] = total
+
+    breakdown_key = "broken_percent" if grain_type == "dal" else "broken_percentages"
+    broken_breakdown = {"25%": 0, "50%": 0, "75%": 0}
+    for result in results:
+        for size, count in (result.get(breakdown_key) or {}).items():
+            broken_breakdown[size] = broken_breakdown.get(size, 0) + count
+
+    broken_percent_per_image = [
+        100.0 * result.get("broken_grain_count", 0) / total_count(grain_type, result)
+        for result in results if total_count(grain_type, result)
+    ]
+
+    def ratio(field):
+        return round(totals.get(field, 0) / total, 4) if total else 0
+
+    ratios = {"broken": ratio("broken_grain_count")}
+    if grain_type == "dal":
+        ratios["black"] = ratio("black_dal")
+    else:
+        ratios.update({"chalky": ratio("chalky_count"), "yellow": ratio("yellow_count")})
+
+    return {
+        "grain_type": grain_type,
+        "images": len(results),
+        "totals": totals,
+        "broken_breakdown": broken_breakdown,
+        "broken_percent_per_image": _spread(broken_percent_per_image),
+        "ratios": ratios,
+    }
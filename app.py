@@ -1,13 +1,26 @@
+import io
 import os
+import sys
 import socket
 import time
-from flask import Flask, render_template, Response, request, redirect, url_for, jsonify
+from flask import Flask, Request, render_template, Response, request, redirect, url_for, jsonify, stream_with_context, send_from_directory, g
 import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import json
 import datetime
 from werkzeug.utils import secure_filename
 import cv2
 import uuid
+import config
+import metrics
+import connectivity
+from retention import RetentionIndex
+from overlay_writer import OverlayWriter
+from static_assets import StaticAssets, IMMUTABLE_CACHE_CONTROL
+from sync_worker import SyncWorker, SYNC_NOW
+from outbox import open_result_store
+from mongodb_models import stored_document
 
 # Create a function to ensure localhost is available before starting Flask
 def ensure_loopback_available():
@@ -28,8 +41,30 @@ def ensure_loopback_available():
     print("WARNING: Could not confirm loopback interface availability!")
     return False
 
+class InMemoryUploadRequest(Request):
+    """Keeps multipart file parts in memory instead of spooling large ones to a temp file."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+    @property
+    def max_content_length(self):
+        # A batch carries up to BATCH_MAX_IMAGES trays, each bounded on its own
+        if self.endpoint == 'batch_analysis':
+            return config.BATCH_MAX_IMAGES * config.BATCH_IMAGE_MAX_BYTES
+        return super().max_content_length
+
+class AnalyzerFlask(Flask):
+    """Lets browsers cache captured images, which are never rewritten under the same name."""
+
+    def get_send_file_max_age(self, filename):
+        if filename and filename.startswith('captured/'):
+            return config.IMAGE_CACHE_SECONDS
+        return super().get_send_file_max_age(filename)
+
 # Initialize app with explicit loopback listening
-app = Flask(__name__)
+app = AnalyzerFlask(__name__)
+app.request_class = InMemoryUploadRequest
 
 # Folders setup
 UPLOAD_FOLDER = os.path.join(app.root_path, 'static', 'uploads')
@@ -41,26 +76,103 @@ os.makedirs(CAPTURE_FOLDER, exist_ok=True)
 PROCESSED_FOLDER = os.path.join(app.root_path, 'static', 'processed')
 os.makedirs(PROCESSED_FOLDER, exist_ok=True)
 
-# Local storage for results
+# Local storage for results; one JSON file per result in these folders is the
+# oldest layout, imported into the result store at startup
 LOCAL_STORAGE_DIR = os.path.join(app.root_path, 'local_storage')
 RICE_STORAGE = os.path.join(LOCAL_STORAGE_DIR, 'rice')
 DAL_STORAGE = os.path.join(LOCAL_STORAGE_DIR, 'dal')
 
-os.makedirs(RICE_STORAGE, exist_ok=True)
-os.makedirs(DAL_STORAGE, exist_ok=True)
-
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['CAPTURE_FOLDER'] = CAPTURE_FOLDER
 app.config['PROCESSED_FOLDER'] = PROCESSED_FOLDER
+# Uploads are held in memory, so bound their size
+app.config['MAX_CONTENT_LENGTH'] = config.MAX_UPLOAD_BYTES
 
 # Constants
 MAX_IMAGES = 50
 MAC_ADDRESS = "d8:3a:dd:c0:77:fd"
 
+# Retention of captured and processed images, indexed once at startup
+captured_images = RetentionIndex(CAPTURE_FOLDER, max_files=MAX_IMAGES, max_bytes=config.CAPTURED_MAX_BYTES)
+processed_images = RetentionIndex(PROCESSED_FOLDER, max_files=MAX_IMAGES, max_bytes=config.PROCESSED_MAX_BYTES,
+                                  extensions=('.jpg', '.webp'))
+UPLOAD_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+uploaded_images = RetentionIndex(UPLOAD_FOLDER, max_files=MAX_IMAGES, max_bytes=config.UPLOADED_MAX_BYTES,
+                                 extensions=UPLOAD_EXTENSIONS)
+
+# Originals from /analyze_upload are persisted off the request thread
+upload_writer = ThreadPoolExecutor(max_workers=1)
+
+# Overlays are encoded and written in the background
+overlay_writer = OverlayWriter(processed_images, image_format=config.OVERLAY_FORMAT, quality=config.OVERLAY_QUALITY,
+                               max_dimension=config.OVERLAY_MAX_DIMENSION, cache_size=config.OVERLAY_CACHE_SIZE)
+
+# Saved results go to the SQLite outbox (or the journal, see config.RESULT_STORE),
+# which the sync code reads and acknowledges
+result_store = open_result_store(app.root_path)
+
+# One worker syncs saved results to MongoDB, coalescing bursts of saves into one pass
+sync_worker = SyncWorker(app.root_path, result_store, interval=config.SYNC_INTERVAL_SECONDS,
+                         debounce=config.SYNC_DEBOUNCE_SECONDS, max_delay=config.SYNC_MAX_DELAY_SECONDS,
+                         connectivity=connectivity.monitor())
+
+# Fingerprinted, precompressed copies of the static files, served from /assets/
+static_assets = StaticAssets(os.path.join(app.root_path, 'static'), exclude=('captured', 'processed', 'uploads'))
+
+@app.context_processor
+def inject_asset_url():
+    if app.debug:
+        static_assets.scan()  # Pick up edits without a restart; unchanged files are only stat()ed
+    return {'asset_url': lambda filename: url_for('asset', filename=static_assets.url_name(filename))}
+
+# Metrics: per-route latency, and gauges read at scrape time
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_request_metrics(response):
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_latency.observe(time.monotonic() - started, route=route, method=request.method)
+        metrics.http_requests.inc(route=route, method=request.method, status=response.status_code)
+    return response
+
+def local_storage_backlog():
+    """Saved results waiting to be synced, per grain type."""
+    return {grain_type: result_store.backlog(grain_type) for grain_type in ('rice', 'dal')}
+
+def queue_depth():
+    jobs = sys.modules.get('jobs')
+    return jobs.queue_depth() if jobs else 0
+
+metrics.Gauge("analyzer_analysis_queue_depth", "Analysis jobs queued or running", queue_depth)
+metrics.Gauge("analyzer_images_retained", "Images kept on disk, by folder",
+              lambda: {'captured': captured_images.stats()['files'], 'processed': processed_images.stats()['files']},
+              labels=('folder',))
+metrics.Gauge("analyzer_image_bytes_on_disk", "Bytes of images kept on disk, by folder",
+              lambda: {'captured': captured_images.stats()['bytes'], 'processed': processed_images.stats()['bytes']},
+              labels=('folder',))
+metrics.Gauge("analyzer_sync_backlog_results", "Saved results not yet synced to MongoDB, by grain type",
+              local_storage_backlog, labels=('grain_type',))
+metrics.Gauge("analyzer_sync_last_success_timestamp_seconds", "Unix time of the last successful MongoDB sync",
+              lambda: sync_worker.last_success)
+metrics.Gauge("analyzer_connectivity_state", "1 for the current cloud connectivity state",
+              lambda: {state: int(state == connectivity.monitor().state)
+                       for state in (connectivity.OFFLINE, connectivity.PROBING, connectivity.ONLINE, connectivity.DEGRADED)},
+              labels=('state',))
+
 # Initialize camera only when needed
 camera = None
+camera_lock = threading.Lock()
 
 def initialize_camera():
+    # The warm-up thread and the first request may race to open the camera
+    with camera_lock:
+        return _initialize_camera_locked()
+
+def _initialize_camera_locked():
     global camera
     if camera is None:
         try:
@@ -81,49 +193,33 @@ def initialize_camera():
             camera = None
     return camera
 
-def cleanup_old_images(directory, max_files=10):
-    """Deletes the oldest image if the directory contains more than `max_files` images."""
-    files = sorted(
-        (os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.jpg')),
-        key=os.path.getctime  # Sort by creation time (oldest first)
-    )
-    while len(files) > max_files:
-        os.remove(files.pop(0))  # Remove oldest file
-
-def manage_captured_images():
-    """Ensures that only the last 10 captured images are stored."""
-    images = sorted(os.listdir(CAPTURE_FOLDER), key=lambda x: os.path.getctime(os.path.join(CAPTURE_FOLDER, x)))
-    while len(images) > MAX_IMAGES:
-        os.remove(os.path.join(CAPTURE_FOLDER, images.pop(0)))
-
 def gen(camera):
     """Generates frames for live video feed."""
     while True:
         frame = camera.get_frame()
         if not frame:
             continue
+        metrics.camera_frames.inc()
         yield (b'--frame\r\n'
                b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
 
+def as_stored_document(grain_type, data):
+    """Raw results become documents; records that already are documents pass through."""
+    return data if isinstance(data.get("created_at"), str) else stored_document(grain_type, data)
+
 def save_locally(data, grain_type):
-    """Save analysis results locally as JSON files."""
+    """Store the MongoDB document for analysis results locally; returns the record's id."""
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-    storage_dir = RICE_STORAGE if grain_type == 'rice' else DAL_STORAGE
     
     # Add timestamp to data
     data['timestamp'] = timestamp
     data['device_id'] = MAC_ADDRESS
-    data['synced'] = False
-    
-    # Save to file
-    filename = f"{grain_type}_{timestamp}.json"
-    filepath = os.path.join(storage_dir, filename)
     
-    with open(filepath, 'w') as f:
-        json.dump(data, f)
+    # Returns once the record is on disk
+    seq = result_store.append(grain_type, stored_document(grain_type, data))
     
-    print(f"Saved {grain_type} results locally: {filename}")
-    return filename
+    print(f"Saved {grain_type} results locally: record {seq}")
+    return seq
 
 # Routes
 @app.route('/video_feed')
@@ -137,93 +233,142 @@ def video_feed():
 
 @app.route('/capture', methods=['POST'])
 def capture():
-    """Captures an image from the camera and saves it."""
+    """
+    Captures an image from the camera and saves it.
+    In burst mode several frames are grabbed and only the sharpest one
+    (or a median stack of the sharpest ones) is encoded and written.
+    """
+    from focus import select_frame, BURST_MODES
+    options = request.get_json(silent=True) or {}
+    try:
+        burst = int(options.get("burst", config.CAPTURE_BURST_FRAMES))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid burst size"}), 400
+    if burst > config.CAPTURE_BURST_MAX_FRAMES:
+        # Every frame of a burst is held in memory at full resolution
+        return jsonify({"error": f"At most {config.CAPTURE_BURST_MAX_FRAMES} frames per burst"}), 400
+    mode = options.get("mode", config.CAPTURE_BURST_MODE)
+    if mode not in BURST_MODES:
+        return jsonify({"error": f"Unknown burst mode: {mode}"}), 400
+
     cam = initialize_camera()
     if not cam:
         return jsonify({"error": "Camera not available"}), 503
-        
-    frame = cam.get_frame()
+
+    sharpness = None
+    if burst > 1:
+        try:
+            best, sharpness = select_frame(cam.capture_burst(burst), mode=mode)
+            ok, encoded = cv2.imencode('.jpg', best, [cv2.IMWRITE_JPEG_QUALITY, config.CAPTURE_JPEG_QUALITY])
+            frame = encoded.tobytes() if ok else b""
+        except Exception as e:
+            print(f"Burst capture failed: {str(e)}")
+            return jsonify({"error": f"Capture failed: {str(e)}"}), 500
+    else:
+        frame = cam.get_frame()
+
     if frame:
-        timestamp = int(time.time())  # Unique filename based on timestamp
-        filename = f"captured_{timestamp}.jpg"
+        filename = captured_images.new_filename("captured")  # Unique filename based on timestamp
         filepath = os.path.join(app.config['CAPTURE_FOLDER'], filename)
         print(f"Saving captured image to: {filepath}")
         try:
             with open(filepath, "wb") as f:
                 f.write(frame)
             print(f"Successfully saved image, size: {len(frame)} bytes")
-            manage_captured_images()  # Keep only the last 10 images
-            return jsonify({"image_url": url_for('static', filename=f'captured/{filename}')})
+            captured_images.add(filename)  # Keep only the last MAX_IMAGES images
+            response = {"image_url": url_for('static', filename=f'captured/{filename}')}
+            if sharpness is not None:
+                response["sharpness"] = round(sharpness, 2)
+                response["burst"] = burst
+            return jsonify(response)
         except Exception as e:
+            captured_images.discard(filename)
             print(f"Error saving image: {str(e)}")
             return jsonify({"error": f"Capture failed: {str(e)}"}), 500
     print("Camera returned no frame data")
     return jsonify({"error": "Capture failed: No frame data"}), 500
 
-@app.route('/process_image', methods=['POST'])
-def process_image_route():
+def resolve_image_path(image_path):
+    """Build full path to the image (remove any leading '/' if present)."""
+    return os.path.join(app.root_path, image_path.lstrip('/'))
+
+def serialize_job(job):
+    """JSON view of a job, with the overlay URL filled in once it is done."""
+    response = {
+        "job_id": job["id"],
+        "grain_type": job["grain_type"],
+        "status": job["status"],
+    }
+    if job["status"] == "done":
+        result = dict(job["result"])
+        processed_filename = result.pop("processed_filename", None)
+        if processed_filename is not None:  # Vector-mode results carry overlay_vector instead
+            result["processed_image_url"] = url_for('processed_image', filename=processed_filename)
+        response["result"] = result
+    elif job["status"] == "failed":
+        response["error"] = job["error"]
+    return response
+
+def queue_full_response(e, status=429):
+    response = jsonify({"error": str(e)})
+    response.status_code = status
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def submit_analysis(grain_type, image_path=None, image=None, overlay_mode=None):
     """
-    Processes an image to detect and analyze rice grains, stones, and husks.
-    Returns detailed analysis results including different types of grains.
+    Queue an analysis job for a saved image or an already decoded one,
+    returning (job_id, None) or (None, error response).
+    `overlay_mode` is "image" or "vector", by default config.OVERLAY_MODE.
     """
-    data = request.get_json()
+    import jobs
+    if image is None:
+        image = cv2.imread(resolve_image_path(image_path))
+    if image is None:
+        return None, (jsonify({"error": "Image not found"}), 404)
+    try:
+        return jobs.submit(grain_type, image, overlay_writer,
+                           overlay_mode=overlay_mode or config.OVERLAY_MODE), None
+    except jobs.QueueFull as e:
+        return None, queue_full_response(e)
+    except jobs.PoolRestarted as e:
+        return None, queue_full_response(e, 503)
+    except ValueError as e:
+        return None, (jsonify({"error": str(e)}), 400)
+
+def run_analysis(grain_type):
+    """Queue an analysis and wait for it, for the synchronous routes."""
+    import jobs
+    data = request.get_json(silent=True) or {}
     image_path = data.get("image_path")
 
     if not image_path:
         return jsonify({"error": "Invalid request"}), 400
 
-    # Build full path to the image (remove any leading '/' if present)
-    image_full_path = os.path.join(app.root_path, image_path.lstrip('/'))
-    
-    image = cv2.imread(image_full_path)
-    if image is None:
-        return jsonify({"error": "Image not found"}), 404
-
-    # Import process_image lazily to avoid import errors at startup
-    try:
-        from process_image import detect_and_count_rice_grains
-        processed_result = detect_and_count_rice_grains(image)
-        
-        # Unpack results from the new function (7 values)
-        final_image = processed_result[0]
-        full_grain_count = processed_result[1]
-        broken_grain_count = processed_result[2]
-        chalky_count = processed_result[3]
-        black_count = processed_result[4]
-        yellow_count = processed_result[5]
-        broken_percentages = processed_result[6]
-
-        # Set default values for stone and husk since new version doesn't detect them
-        stone_count = 0
-        husk_count = 0
-        brown_count = 0  # Also not detected in new version
-
-        # Calculate total count
-        total_objects = full_grain_count + chalky_count + black_count + yellow_count + brown_count + broken_grain_count + stone_count + husk_count
-
-        # Save processed image with a timestamp-based filename
-        processed_filename = f"processed_{int(time.time())}.jpg"
-        processed_filepath = os.path.join(PROCESSED_FOLDER, processed_filename)
-        cv2.imwrite(processed_filepath, final_image)
-
-        # Cleanup old processed images (keep only 50)
-        cleanup_old_images(PROCESSED_FOLDER, max_files=MAX_IMAGES)
+    job_id, error_response = submit_analysis(grain_type, image_path, overlay_mode=data.get("overlay"))
+    if error_response is not None:
+        return error_response
+    return wait_for_analysis(job_id)
+
+def wait_for_analysis(job_id, extra=None):
+    """Wait for a job and answer with its result, like the original inline routes did."""
+    import jobs
+    job = jobs.get_job(job_id, wait=config.ANALYSIS_TIMEOUT_SECONDS)
+    if job["status"] == "failed":
+        return jsonify({"error": job["error"]}), 500
+    if job["status"] != "done":
+        return jsonify({"error": "Analysis timed out", "job_id": job_id}), 504
+    result = serialize_job(job)["result"]
+    result.update(extra or {})
+    return jsonify(result)
 
-        return jsonify({
-            "processed_image_url": url_for('static', filename=f'processed/{processed_filename}'),
-            "total_objects": total_objects,
-            "full_grain_count": full_grain_count,
-            "chalky_count": chalky_count,
-            "black_count": black_count,
-            "yellow_count": yellow_count,
-            "brown_count": brown_count,
-            "broken_percentages": broken_percentages,
-            "broken_grain_count": broken_grain_count,
-            "stone_count": stone_count,
-            "husk_count": husk_count
-        })
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+@app.route('/process_image', methods=['POST'])
+def process_image_route():
+    """
+    Processes an image to detect and analyze rice grains, stones, and husks.
+    Returns detailed analysis results including different types of grains.
+    """
+    return run_analysis('rice')
 
 
 @app.route('/process_dal', methods=['POST'])
@@ -232,47 +377,289 @@ def process_dal_route():
     Processes an image to detect and analyze dal grains.
     Returns detailed analysis results including broken percentages and black dal count.
     """
-    data = request.get_json()
+    return run_analysis('dal')
+
+@app.route('/processed/<filename>', methods=['GET'])
+def processed_image(filename):
+    """
+    Serves a processed overlay. Recent overlays come from memory, and a
+    request made while the overlay is still being encoded waits for it.
+    """
+    # Overlay names are unique and never rewritten, so the name is a strong ETag
+    if request.if_none_match.contains(filename):
+        response = Response(status=304)
+        response.set_etag(filename)
+    else:
+        data = overlay_writer.get(filename)
+        if data is not None:
+            response = Response(data, mimetype=overlay_writer.mimetype)
+            response.set_etag(filename)
+        else:
+            response = send_from_directory(PROCESSED_FOLDER, filename, etag=filename)
+    response.cache_control.public = True
+    response.cache_control.max_age = config.IMAGE_CACHE_SECONDS
+    return response
+
+@app.route('/assets/<path:filename>', methods=['GET'])
+def asset(filename):
+    """
+    Serves a static file by its fingerprinted name, in the best encoding the
+    browser accepts. The content behind a name never changes, so it is cached
+    as immutable.
+    """
+    found = static_assets.lookup(filename)
+    if found is None:
+        # Linked from a page that predates an update: send the browser to the current version
+        current = static_assets.current(filename)
+        if current is None:
+            return jsonify({"error": "Not found"}), 404
+        return redirect(url_for('asset', filename=current.url_name))
+    encoding = static_assets.negotiate(found, request.accept_encodings)
+    etag = found.fingerprint if encoding == 'identity' else f"{found.fingerprint}-{encoding}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(static_assets.variant(found, encoding), mimetype=found.mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    return response
+
+def upload_filename(original):
+    """A fresh name in static/uploads, so later uploads with the same file name do not replace this one."""
+    extension = os.path.splitext(secure_filename(original))[1].lower()
+    return uploaded_images.new_filename("upload", extension if extension in UPLOAD_EXTENSIONS else '.jpg')
+
+def persist_upload(filename, data):
+    try:
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'wb') as f:
+            f.write(data)
+        uploaded_images.add(filename)  # Keep only the last MAX_IMAGES uploads
+    except Exception as e:
+        uploaded_images.discard(filename)
+        print(f"Error saving upload {filename}: {str(e)}")
+
+@app.route('/analyze_upload', methods=['POST'])
+def analyze_upload():
+    """
+    Decodes an uploaded image in memory and analyzes it, without first
+    saving it to static/uploads and reading it back.
+    Form fields: `file`, `grain_type` (rice or dal), `overlay` (image or
+    vector), `persist` (1 to keep the original in static/uploads, written in
+    the background) and `async` (1 to return a job id instead of waiting for
+    the result).
+    """
+    import numpy as np
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        return jsonify({"error": "No file uploaded"}), 400
+    grain_type = request.form.get('grain_type', 'rice')
+
+    data = file.read()
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return jsonify({"error": "Could not decode image"}), 400
+
+    job_id, error_response = submit_analysis(grain_type, image=image, overlay_mode=request.form.get('overlay'))
+    if error_response is not None:
+        return error_response
+
+    extra = {}
+    if request.form.get('persist') == '1':
+        filename = upload_filename(file.filename)
+        upload_writer.submit(persist_upload, filename, data)
+        extra["uploaded_image_url"] = url_for('static', filename=f'uploads/{filename}')
+
+    if request.form.get('async') == '1':
+        extra.update({
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": url_for('job_status', job_id=job_id)
+        })
+        return jsonify(extra), 202
+    return wait_for_analysis(job_id, extra)
+
+@app.route('/batch', methods=['POST'])
+def batch_analysis():
+    """
+    Analyzes a lot of several trays in one request.
+    Accepts either multipart `files` (with a `grain_type` form field) or JSON
+    with `image_paths` and/or `capture_ids` plus `grain_type`. The images are
+    fanned out over the job worker pool and the response streams one
+    newline-delimited JSON line per image as it completes, followed by a
+    `summary` line with the lot-level aggregates.
+    """
+    import numpy as np
+    import jobs
+    from analysis import PIPELINES, OVERLAY_MODES, aggregate_results
+
+    sources = []  # (label, function returning the decoded image or None)
+    if request.files:
+        grain_type = request.form.get('grain_type', 'rice')
+        overlay_mode = request.form.get('overlay') or config.OVERLAY_MODE
+        for file in request.files.getlist('files'):
+            data = file.read()
+            if len(data) > config.BATCH_IMAGE_MAX_BYTES:
+                return jsonify({"error": f"{file.filename} is larger than {config.BATCH_IMAGE_MAX_BYTES} bytes"}), 413
+            sources.append((file.filename, lambda data=data: cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)))
+    else:
+        data = request.get_json(silent=True) or {}
+        grain_type = data.get('grain_type', 'rice')
+        overlay_mode = data.get('overlay') or config.OVERLAY_MODE
+        for image_path in data.get('image_paths', []):
+            sources.append((image_path, lambda image_path=image_path: cv2.imread(resolve_image_path(image_path))))
+        for capture_id in data.get('capture_ids', []):
+            filename = secure_filename(capture_id)
+            if not filename.endswith('.jpg'):
+                filename += '.jpg'
+            sources.append((capture_id, lambda filename=filename: cv2.imread(os.path.join(CAPTURE_FOLDER, filename))))
+
+    if grain_type not in PIPELINES:
+        return jsonify({"error": f"Unknown grain type: {grain_type}"}), 400
+    if overlay_mode not in OVERLAY_MODES:
+        return jsonify({"error": f"Unknown overlay mode: {overlay_mode}"}), 400
+    if not sources:
+        return jsonify({"error": "No images given"}), 400
+    if len(sources) > config.BATCH_MAX_IMAGES:
+        return jsonify({"error": f"At most {config.BATCH_MAX_IMAGES} images per batch"}), 400
+
+    def line(payload):
+        return json.dumps(payload) + "\n"
+
+    def stream():
+        pending = {}  # job_id -> (index, label)
+        results = []
+        next_index = 0
+        staged = None  # Decoded image waiting for a free queue slot
+
+        while next_index < len(sources) or pending:
+            # Submit while the queue has room
+            while next_index < len(sources):
+                label, load = sources[next_index]
+                if staged is None:
+                    staged = load()
+                if staged is None:
+                    yield line({"type": "image", "index": next_index, "source": label,
+                                "status": "failed", "error": "Image not found"})
+                    next_index += 1
+                    continue
+                try:
+                    # Only wait for a slot if none of our own jobs can free one
+                    job_id = jobs.submit(grain_type, staged, overlay_writer, overlay_mode=overlay_mode,
+                                         block=0 if pending else config.ANALYSIS_TIMEOUT_SECONDS)
+                except (jobs.QueueFull, jobs.PoolRestarted) as e:
+                    # A restarted pool fails our pending jobs too, so only a full queue is worth waiting out
+                    if pending and isinstance(e, jobs.QueueFull):
+                        break
+                    for index in range(next_index, len(sources)):
+                        yield line({"type": "image", "index": index, "source": sources[index][0],
+                                    "status": "failed", "error": str(e)})
+                    next_index = len(sources)
+                    break
+                pending[job_id] = (next_index, label)
+                staged = None
+                next_index += 1
+
+            if not pending:
+                continue
+            finished, snapshots = jobs.wait_any(list(pending), timeout=config.ANALYSIS_TIMEOUT_SECONDS)
+            if not finished:
+                for index, label in pending.values():
+                    yield line({"type": "image", "index": index, "source": label,
+                                "status": "failed", "error": "Analysis timed out"})
+                pending.clear()
+                continue
+            by_id = {job["id"]: job for job in snapshots}
+            for job_id in finished:
+                index, label = pending.pop(job_id)
+                job = serialize_job(by_id[job_id]) if job_id in by_id else {"status": "failed", "error": "Job expired"}
+                payload = {"type": "image", "index": index, "source": label, "status": job["status"]}
+                if job["status"] == "done":
+                    payload["result"] = job["result"]
+                    results.append(job["result"])
+                else:
+                    payload["error"] = job.get("error")
+                yield line(payload)
+
+        summary = aggregate_results(grain_type, results)
+        summary["type"] = "summary"
+        summary["failed"] = len(sources) - len(results)
+        yield line(summary)
+
+    return Response(stream_with_context(stream()), mimetype='application/x-ndjson')
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """
+    Queues an analysis and returns its job id immediately.
+    Answers 429 with Retry-After when the analysis queue is full, and 503
+    with Retry-After while the worker pool restarts after a worker died.
+    """
+    data = request.get_json(silent=True) or {}
     image_path = data.get("image_path")
+    grain_type = data.get("grain_type", "rice")
 
     if not image_path:
         return jsonify({"error": "Invalid request"}), 400
 
-    # Build full path to the image (remove any leading '/' if present)
-    image_full_path = os.path.join(app.root_path, image_path.lstrip('/'))
-    
-    image = cv2.imread(image_full_path)
-    if image is None:
-        return jsonify({"error": "Image not found"}), 404
-
-    # Process dal image with enhanced process_dal function
+    job_id, error_response = submit_analysis(grain_type, image_path, overlay_mode=data.get("overlay"))
+    if error_response is not None:
+        return error_response
+    return jsonify({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": url_for('job_status', job_id=job_id)
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Returns the state of an analysis job.
+    Pass ?wait=<seconds> to block until the job finishes (long polling).
+    """
+    import jobs
     try:
-        from procress_dal import process_dal
-        full_grain_count, broken_grain_count, broken_percent, visualization_image, black_dal = process_dal(image)
-
-        # Save processed image with a timestamp-based filename
-        processed_filename = f"processed_dal_{int(time.time())}.jpg"
-        processed_filepath = os.path.join(PROCESSED_FOLDER, processed_filename)
-        cv2.imwrite(processed_filepath, visualization_image)
+        wait = min(float(request.args.get('wait', 0)), config.ANALYSIS_TIMEOUT_SECONDS)
+    except ValueError:
+        return jsonify({"error": "Invalid wait"}), 400
+    job = jobs.get_job(job_id, wait=max(wait, 0))
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(serialize_job(job))
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """
+    Server-Sent Events stream of a job's progress.
+    Sends a `progress` event per pipeline stage (preprocess, segmentation,
+    classification with partial counts, overlay), then a final `result`
+    or `failed` event carrying the same payload as GET /jobs/<job_id>.
+    """
+    import jobs
+    if jobs.get_job(job_id) is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    def stream():
+        for event in jobs.iter_events(job_id):
+            if event is None:
+                yield ": keep-alive\n\n"
+            elif event["stage"] == "done":
+                job = serialize_job(event["job"])
+                name = "result" if job["status"] == "done" else "failed"
+                yield f"event: {name}\ndata: {json.dumps(job)}\n\n"
+            else:
+                yield f"event: progress\ndata: {json.dumps(event)}\n\n"
 
-        # Cleanup old processed images (keep only 50)
-        cleanup_old_images(PROCESSED_FOLDER, max_files=MAX_IMAGES)
-        
-        return jsonify({
-            "processed_image_url": url_for('static', filename=f'processed/{processed_filename}'),
-            "full_grain_count": full_grain_count,
-            "broken_grain_count": broken_grain_count,
-            "broken_percent": broken_percent,
-            "black_dal": black_dal  # Fixed: changed from black_dal_count to black_dal
-        })
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/save_results', methods=['POST'])
 def save_results():
     """
     Receives and saves analysis results locally.
-    Tries to start MongoDB sync but won't block if it fails.
+    The sync worker is notified and uploads them in the background.
     """
     try:
         data = request.get_json()
@@ -288,32 +675,14 @@ def save_results():
                 print("==== DAL RESULT SAVED ====")
                 grain_type = 'dal'
                 
-            filename = save_locally(data, grain_type)
+            seq = save_locally(data, grain_type)
             
-            # Try to start MongoDB sync but don't block if it fails
-            try:
-                # Start a separate thread that attempts to import and sync
-                def try_sync():
-                    try:
-                        # We're explicitly using a try/except here since imports might fail
-                        import importlib
-                        mongo_sync = importlib.import_module('mongodb_sync')
-                        mongo_sync.attempt_sync_to_mongodb(app.root_path)
-                    except Exception as e:
-                        print(f"MongoDB sync failed but app continues: {e}")
-                
-                # Start the sync in a background thread
-                sync_thread = threading.Thread(target=try_sync)
-                sync_thread.daemon = True
-                sync_thread.start()
-                
-            except Exception as e:
-                # Even if thread creation fails, we still return success for saving locally
-                print(f"Could not start sync thread: {e}")
-                
+            # Saves in quick succession are merged into one sync pass
+            sync_worker.notify()
+
             return jsonify({
                 "success": True,
-                "message": f"Results saved locally as {filename}"
+                "message": f"Results saved locally as {grain_type} record {seq}"
             })
         else:
             return jsonify({"error": "No valid results to save"}), 400
@@ -321,6 +690,95 @@ def save_results():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/sync/status', methods=['GET'])
+def sync_status():
+    """State of the MongoDB sync worker and the number of results waiting."""
+    return jsonify(sync_worker.status())
+
+@app.route('/sync', methods=['POST'])
+def sync_now():
+    """Asks the sync worker for a pass right away, without waiting for more saves."""
+    sync_worker.notify(SYNC_NOW)
+    return jsonify({"success": True, "status_url": url_for('sync_status')}), 202
+
+def time_arg(name):
+    """A query parameter given as Unix seconds or an ISO 8601 datetime; None if absent."""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+def time_range_args():
+    """(since, until) from ?since=&until=, or ?hours= for the last few hours."""
+    since, until = time_arg('since'), time_arg('until')
+    if request.args.get('hours'):
+        since = time.time() - float(request.args['hours']) * 3600
+    return since or 0, until
+
+@app.route('/history', methods=['GET'])
+def history():
+    """
+    Locally saved results, newest first, with their sync state.
+    Filters: grain_type, since/until (Unix seconds or ISO 8601) or hours.
+    Pages hold `limit` results; pass the returned `next_cursor` as `cursor`.
+    """
+    if not hasattr(result_store, 'history'):
+        return jsonify({"error": "Local history needs RESULT_STORE = \"sqlite\""}), 501
+    try:
+        since, until = time_range_args()
+        limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+        cursor = request.args.get('cursor')
+        before = None
+        if cursor:
+            saved_at, row_id = cursor.split(':')
+            before = (float(saved_at), int(row_id))
+        results, next_page = result_store.history(request.args.get('grain_type') or None, since, until,
+                                                  limit, before)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+    return jsonify({
+        "results": results,
+        "next_cursor": f"{next_page[0]!r}:{next_page[1]}" if next_page else None,
+    })
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """
+    Hourly or daily statistics of locally saved results, read from rollups.
+    Takes grain_type (default rice), period (hour or day) and the same time
+    filters as /history. Buckets overlapping the range are included whole.
+    """
+    from outbox import rollup_summary
+    if not hasattr(result_store, 'rollups'):
+        return jsonify({"error": "Local statistics need RESULT_STORE = \"sqlite\""}), 501
+    grain_type = request.args.get('grain_type', 'rice')
+    period = request.args.get('period', 'hour')
+    try:
+        since, until = time_range_args()
+        buckets = result_store.rollups(grain_type, period, since, until)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+    return jsonify({
+        "grain_type": grain_type,
+        "period": period,
+        "buckets": [dict(rollup_summary([bucket]), bucket_start=bucket["bucket_start"]) for bucket in buckets],
+        "summary": rollup_summary(buckets),
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """Prometheus text-format metrics for fleet monitoring."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Reports the start-up warm-up state of the camera and analysis pipelines."""
+    from warmup import get_status
+    return jsonify(get_status())
+
 @app.route('/wifi', methods=['GET', 'POST'])
 def wifi():
     """Handles WiFi configuration."""
@@ -364,6 +822,8 @@ def wifi_connect():
         # Import here to avoid startup issues
         from wifi_manager import connect_to_network
         success, message = connect_to_network(ssid, password)
+        if success:
+            connectivity.monitor().nudge()  # Check the new network now rather than after the backoff
         
         return jsonify({
             'success': success,
@@ -416,9 +876,14 @@ def index():
         file = request.files['file']
         if file.filename == '':
             return render_template('index.html', error='No selected file')
-        filename = secure_filename(file.filename)
+        filename = upload_filename(file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        try:
+            file.save(filepath)
+        except Exception:
+            uploaded_images.discard(filename)
+            raise
+        uploaded_images.add(filename)  # Keep only the last MAX_IMAGES uploads
         uploaded_image = filepath
     return render_template('index.html', uploaded_image=uploaded_image)
 
@@ -439,6 +904,22 @@ def system_restart():
     except Exception as e:
         return jsonify({"success": False, "message": str(e)})
 
+def start_background_services():
+    """Starts the work that should begin with the server, for app.py and serve.py alike."""
+    # Open the camera and warm both pipelines while the server starts
+    from warmup import start_warmup
+    start_warmup(initialize_camera)
+    # The app is the result store's only writer; results saved in older layouts are moved in
+    result_store.open_for_append()
+    for grain_type, storage_dir in (('rice', RICE_STORAGE), ('dal', DAL_STORAGE)):
+        result_store.import_files(grain_type, storage_dir, functools.partial(as_stored_document, grain_type))
+    if config.RESULT_STORE == 'sqlite' and os.path.isdir(os.path.join(LOCAL_STORAGE_DIR, 'journal')):
+        from journal import open_journal
+        result_store.import_journal(open_journal(app.root_path), as_stored_document)
+    sync_worker.start()
+    # Compress the static assets before the first page load asks for them
+    threading.Thread(target=static_assets.precompress, daemon=True).start()
+
 if __name__ == '__main__':
     def get_mac_address():
         mac = uuid.getnode()
@@ -446,6 +927,7 @@ if __name__ == '__main__':
         return mac_address
     
     ensure_loopback_available()
-    
+    start_background_services()
 
+    # Development server; use serve.py in production
     app.run(debug=True, host="0.0.0.0", port=5000, use_reloader=False, threaded=True)
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""
+Bandwidth bookkeeping for the sync engine.
+
+- `BatchSizer` picks the number of results per bulk write from the measured
+  upload rate, so that one write takes about `target_seconds`: large batches
+  on a fast link, small ones that finish well within the socket timeout on a
+  slow one. A write that fails halves the size.
+- `ByteBudget` caps the bytes uploaded per window on metered connections. Its
+  state is kept in a file so the app and the standalone daemon, which take
+  turns holding the sync lease, share one budget. Batches reserve their bytes
+  before the write and are charged only for what MongoDB acknowledged.
+- `TransferStats` counts results and bytes sent, for bytes per result and an
+  estimate of how long the backlog takes to drain.
+
+Sizes are BSON bytes before wire compression, as the driver does not report
+compressed sizes.
+"""
+import os
+import json
+import time
+import threading
+
+
+def document_size(document):
+    """Encoded BSON size of a document."""
+    import bson  # Ships with pymongo
+    return len(bson.encode(document))
+
+
+class BatchSizer:
+    """Batch size adapted to the measured upload rate."""
+
+    def __init__(self, initial, minimum, maximum, target_seconds, smoothing=0.3):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._size = max(minimum, min(maximum, initial))
+        self._rate = None  # Results per second, smoothed
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._size
+
+    def record(self, results, seconds):
+        """Account for a write of `results` results that took `seconds`."""
+        if results <= 0 or seconds <= 0:
+            return
+        rate = results / seconds
+        with self._lock:
+            self._rate = rate if self._rate is None else (1 - self.smoothing) * self._rate + self.smoothing * rate
+            self._size = max(self.minimum, min(self.maximum, int(self._rate * self.target_seconds)))
+
+    def failed(self):
+        """A write failed, possibly by timing out; try smaller batches."""
+        with self._lock:
+            self._size = max(self.minimum, self._size // 2)
+
+
+class ByteBudget:
+    """At most `limit` bytes per `window` seconds, persisted in `path`. A limit of None means unlimited."""
+
+    def __init__(self, path, limit, window=3600):
+        self.path = path
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._reserved = 0  # Bytes of writes in flight, not yet charged
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {}
+        now = time.time()
+        if now - state.get("window_start", 0) >= self.window:
+            state = {"window_start": now, "bytes": 0}
+        return state
+
+    def _save(self, state):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def remaining(self):
+        if self.limit is None:
+            return None
+        with self._lock:
+            return max(0, self.limit - self._load()["bytes"] - self._reserved)
+
+    def take(self, sizes):
+        """
+        Reserve bytes for the longest prefix of `sizes` that fits in the
+        budget and return its length. A single item larger than the whole
+        limit is let through once nothing else is reserved or spent in the
+        window, so it cannot block the ones after it forever. Every
+        reservation must be `settle`d once its write is done.
+        """
+        if self.limit is None:
+            return len(sizes)
+        with self._lock:
+            used = self._load()["bytes"] + self._reserved
+            count = 0
+            for size in sizes:
+                if used + size > self.limit and not (count == 0 and used == 0 and size > self.limit):
+                    break
+                used += size
+                self._reserved += size
+                count += 1
+            return count
+
+    def settle(self, reserved, spent):
+        """Release `reserved` bytes and charge the `spent` bytes of them that MongoDB acknowledged."""
+        if self.limit is None:
+            return
+        with self._lock:
+            self._reserved = max(0, self._reserved - reserved)
+            if spent:
+                state = self._load()
+                state["bytes"] += spent
+                self._save(state)
+
+    def resets_in(self):
+        """Seconds until the current window ends."""
+        with self._lock:
+            return max(0.0, self._load()["window_start"] + self.window - time.time())
+
+
+class TransferStats:
+    """Results and bytes uploaded, overall and in the last pass."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.results = 0
+        self.bytes = 0
+        self.seconds = 0.0  # Time spent in passes that uploaded something
+        self.last_pass = None
+
+    def record_pass(self, results, sent_bytes, seconds):
+        with self._lock:
+            if results:
+                self.results += results
+                self.bytes += sent_bytes
+                self.seconds += seconds
+            self.last_pass = {"results": results, "bytes": sent_bytes, "seconds": round(seconds, 3)}
+
+    def status(self, backlog=None):
+        with self._lock:
+            rate = self.results / self.seconds if self.seconds else None
+            return {
+                "results_sent": self.results,
+                "bytes_sent": self.bytes,
+                "bytes_per_result": round(self.bytes / self.results, 1) if self.results else None,
+                "results_per_second": round(rate, 2) if rate else None,
+                "estimated_drain_seconds": round(backlog / rate, 1) if rate and backlog is not None else None,
+                "last_pass": self.last_pass,
+            }
@@ -13,6 +13,24 @@ class Camera:
         self.picam2.start()
         time.sleep(2)  # Allow time for the camera to warm up
 
+    def get_array(self):
+        """Grab the latest frame from the stream as a BGR numpy array."""
+        import cv2
+        frame = self.picam2.capture_array("main")
+        # The default video format is XBGR8888, which arrives as [R, G, B, 255]
+        if frame.ndim == 3 and frame.shape[2] == 4:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR)
+        return frame
+
+    def capture_burst(self, count, interval=0.05):
+        """Grab `count` consecutive frames from the stream without touching disk."""
+        frames = []
+        for i in range(count):
+            frames.append(self.get_array())
+            if interval and i < count - 1:
+                time.sleep(interval)
+        return frames
+
     def get_frame(self):
         frame = self.picam2.capture_image("main")
         # If the frame is a dict (with JPEG data), return the data.
@@ -0,0 +1,203 @@
+"""
+Shared view of whether the cloud can be reached.
+
+A `ConnectivityMonitor` is in one of four states:
+
+- offline: the last probe (a TCP connection to CONNECTIVITY_PROBE_ADDRESS) failed
+- probing: a probe is in progress and nothing is known yet
+- online: the probe succeeded, and MongoDB has not failed since
+- degraded: the internet is reachable, but connecting or writing to MongoDB failed
+
+Callers ask `online()`. The answer is cached for `ttl` seconds while online.
+While offline or degraded, probes are spaced by exponential backoff with
+jitter, and until the next probe is due every caller gets the cached "no"
+straight away. Only one thread probes at a time. A background thread probes
+on the backoff schedule and calls the listeners on every transition to
+online, so sync starts when the connection returns instead of on a poll.
+"""
+import time
+import random
+import socket
+import logging
+import threading
+
+logger = logging.getLogger('connectivity')
+
+OFFLINE = "offline"
+PROBING = "probing"
+ONLINE = "online"
+DEGRADED = "degraded"
+
+
+def tcp_probe(host, port, timeout):
+    """A probe that succeeds if a TCP connection to (host, port) can be opened."""
+    def probe():
+        socket.create_connection((host, port), timeout=timeout).close()
+    return probe
+
+
+class ConnectivityMonitor:
+    """Connectivity state shared by everything in one process that talks to the cloud."""
+
+    def __init__(self, probe, ttl=30, backoff_initial=5, backoff_max=300, jitter=0.2):
+        self._probe = probe
+        self.ttl = ttl
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._state = PROBING
+        self._checked_at = None  # Monotonic time of the last probe or report
+        self._changed_at = time.time()
+        self._next_probe = 0.0  # Monotonic time before which no probe is made
+        self._failures = 0  # Consecutive failed probes or MongoDB failures
+        self._cloud_failing = False  # MongoDB failed since it last worked
+        self._probing = False
+        self._last_error = None
+        self._listeners = []
+        self._thread = None
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def add_listener(self, callback):
+        """Call `callback()` on every transition to online."""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def start(self):
+        """Start the background thread that probes while offline or degraded."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="connectivity", daemon=True)
+            self._thread.start()
+
+    def _backoff(self):
+        delay = min(self.backoff_max, self.backoff_initial * 2 ** max(self._failures - 1, 0))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _set_state(self, state, error=None):
+        """Record a state under the lock; returns whether this is a transition to online."""
+        previous = self._state
+        now = time.monotonic()
+        if state == ONLINE:
+            if not self._cloud_failing:
+                self._failures = 0
+            self._next_probe = now + self.ttl
+        else:
+            self._failures += 1
+            self._next_probe = now + self._backoff()
+        self._state = state
+        self._checked_at = now
+        self._last_error = error
+        if state != previous:
+            self._changed_at = time.time()
+            logger.info(f"Connectivity {previous} -> {state}" + (f": {error}" if error else ""))
+        self._changed.notify_all()
+        return state == ONLINE and previous != ONLINE
+
+    def _notify_online(self):
+        with self._lock:
+            listeners = list(self._listeners)
+        for callback in listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Connectivity listener failed: {e}")
+
+    def probe(self):
+        """Probe now, unless another thread already is, and return whether online."""
+        with self._lock:
+            if self._probing:
+                return self._state == ONLINE
+            self._probing = True
+            if self._state == OFFLINE:
+                self._state = PROBING
+        error = None
+        try:
+            self._probe()
+        except OSError as e:
+            error = str(e) or type(e).__name__
+        with self._lock:
+            self._probing = False
+            if error is None:
+                # The internet is back, but MongoDB stays suspect until a sync succeeds
+                became_online = self._set_state(ONLINE)
+            else:
+                became_online = self._set_state(OFFLINE, error)
+        if became_online:
+            self._notify_online()
+        return error is None
+
+    def online(self):
+        """Whether the cloud is reachable. Answers from the cache unless a probe is due."""
+        with self._lock:
+            now = time.monotonic()
+            if self._probing or now < self._next_probe:
+                return self._state == ONLINE
+        return self.probe()
+
+    def report_success(self):
+        """MongoDB answered; clears a degraded state."""
+        with self._lock:
+            self._cloud_failing = False
+            became_online = self._set_state(ONLINE)
+        if became_online:
+            self._notify_online()
+
+    def report_failure(self, error):
+        """MongoDB could not be reached or written to although the internet could."""
+        with self._lock:
+            self._cloud_failing = True
+            self._set_state(DEGRADED, str(error))
+
+    def nudge(self):
+        """Probe as soon as possible, e.g. after joining a network."""
+        with self._lock:
+            self._next_probe = 0.0
+            self._changed.notify_all()
+
+    def status(self):
+        with self._lock:
+            return {
+                "state": self._state,
+                "since": self._changed_at,
+                "consecutive_failures": self._failures,
+                "next_probe_in": max(0.0, self._next_probe - time.monotonic()) if self._state != ONLINE else None,
+                "last_error": self._last_error,
+            }
+
+    def _run(self):
+        while True:
+            with self._lock:
+                # While online, nothing to do until a failure or a nudge changes that
+                while self._probing or (self._state == ONLINE and self._next_probe > 0):
+                    self._changed.wait()
+                delay = self._next_probe - time.monotonic()
+                if delay > 0:
+                    self._changed.wait(delay)
+                    continue
+            self.probe()
+
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+def monitor():
+    """The process-wide connectivity monitor."""
+    global _monitor
+    import config
+    with _monitor_lock:
+        if _monitor is None:
+            host, port = config.CONNECTIVITY_PROBE_ADDRESS
+            _monitor = ConnectivityMonitor(
+                tcp_probe(host, port, config.CONNECTIVITY_PROBE_TIMEOUT_SECONDS),
+                ttl=config.CONNECTIVITY_TTL_SECONDS,
+                backoff_initial=config.CONNECTIVITY_BACKOFF_INITIAL_SECONDS,
+                backoff_max=config.CONNECTIVITY_BACKOFF_MAX_SECONDS)
+        return _monitor
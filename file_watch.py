@@ -0,0 +1,176 @@
+"""
+Wake-ups when result files change, for the standalone sync daemon.
+
+On Linux the watched directories are registered with inotify, through ctypes
+so no extra package is needed, and the watching thread sleeps in select()
+until the kernel reports a change. Elsewhere, or if inotify cannot be set up,
+the directories are polled with stat() every `poll_interval` seconds instead.
+
+A watch is a (directory, fnmatch pattern) pair; changes to files whose names
+do not match are ignored. Bursts of changes are debounced into one callback.
+"""
+import os
+import sys
+import time
+import fnmatch
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+logger = logging.getLogger('file_watch')
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+
+def _libc():
+    """The C library if it provides inotify, else None."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class _Inotify:
+    """Kernel change notifications for the watched directories."""
+
+    def __init__(self, watches):
+        libc = _libc()
+        if libc is None:
+            raise OSError("inotify is not available")
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1: {os.strerror(errno)}")
+        self.fd = fd
+        self._patterns = {}  # Watch descriptor -> patterns
+        for directory, pattern in watches:
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, f"inotify_add_watch {directory}: {os.strerror(errno)}")
+            self._patterns.setdefault(wd, []).append(pattern)
+
+    def wait(self, timeout):
+        """True once a matching file changes, False after `timeout` seconds (None waits forever)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if not ready:
+                return False
+            if self._drain():
+                return True
+
+    def _drain(self):
+        """Read all queued events; returns whether any concerned a matching file."""
+        matched = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return matched
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+                start = offset + EVENT_HEADER.size
+                name = data[start:start + length].rstrip(b"\0").decode(errors="replace")
+                offset = start + length
+                if any(fnmatch.fnmatch(name, pattern) for pattern in self._patterns.get(wd, ())):
+                    matched = True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Poller:
+    """stat()-based fallback: compares the size and mtime of matching files."""
+
+    def __init__(self, watches, interval):
+        self.watches = list(watches)
+        self.interval = interval
+        self._last = self._snapshot()
+
+    def _snapshot(self):
+        snapshot = {}
+        for directory, pattern in self.watches:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if fnmatch.fnmatch(entry.name, pattern):
+                            try:
+                                stat = entry.stat()
+                            except FileNotFoundError:
+                                continue
+                            snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                pass
+        return snapshot
+
+    def wait(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+            if remaining <= 0:
+                return False
+            time.sleep(remaining)
+            snapshot = self._snapshot()
+            if snapshot != self._last:
+                self._last = snapshot
+                return True
+
+    def close(self):
+        pass
+
+
+class FileWatcher:
+    """Calls `callback()` once per burst of changes to the watched files."""
+
+    def __init__(self, watches, callback, debounce=2.0, max_delay=10.0, poll_interval=5.0):
+        self.callback = callback
+        self.debounce = debounce
+        self.max_delay = max_delay
+        try:
+            self._source = _Inotify(watches)
+            self.mode = "inotify"
+        except OSError as e:
+            logger.info(f"Watching files by polling every {poll_interval} s ({e})")
+            self._source = _Poller(watches, poll_interval)
+            self.mode = "polling"
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="file-watch", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            if not self._source.wait(None):
+                continue
+            # Wait for the burst to go quiet, but not longer than max_delay
+            deadline = time.monotonic() + self.max_delay
+            while True:
+                remaining = min(self.debounce, deadline - time.monotonic())
+                if remaining <= 0 or not self._source.wait(remaining):
+                    break
+            try:
+                self.callback()
+            except Exception as e:
+                logger.error(f"File watch callback failed: {e}")
@@ -0,0 +1,59 @@
+"""
+Focus scoring for burst captures.
+
+Frames are scored at thumbnail scale with the variance of the Laplacian, which
+is cheap and tracks autofocus blur well. The sharpest frame can then be used
+as-is or median-stacked with the next sharpest ones to reduce sensor noise.
+"""
+import cv2
+import numpy as np
+
+
+def sharpness(frame, thumb_width=320):
+    """Return the variance of the Laplacian of a downscaled grayscale copy of `frame`."""
+    height, width = frame.shape[:2]
+    if width > thumb_width:
+        thumb_height = max(1, int(height * thumb_width / width))
+        frame = cv2.resize(frame, (thumb_width, thumb_height), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def rank_frames(frames, thumb_width=320):
+    """Return (score, frame) pairs sorted from sharpest to blurriest."""
+    scored = [(sharpness(frame, thumb_width), frame) for frame in frames]
+    scored.sort(key=lambda item: item[0], reverse=True)
+    return scored
+
+
+def median_stack(frames):
+    """Per-pixel median of equally sized frames."""
+    return np.median(np.stack(frames), axis=0).astype(np.uint8)
+
+
+# Ways select_frame can combine a burst
+BURST_MODES = ("best", "median")
+
+
+def select_frame(frames, mode="best", stack_size=3, thumb_width=320):
+    """
+    Pick the frame to analyse from a burst.
+
+    Args:
+        frames (list): BGR frames of the same size.
+        mode (str): "best" keeps the sharpest frame, "median" median-stacks
+            the `stack_size` sharpest frames.
+
+    Returns:
+        tuple: Selected frame and the sharpness score of the sharpest frame.
+    """
+    if not frames:
+        raise ValueError("No frames to select from")
+    if mode not in BURST_MODES:
+        raise ValueError(f"Unknown burst mode: {mode}")
+    ranked = rank_frames(frames, thumb_width)
+    best_score, best_frame = ranked[0]
+    if mode == "median" and len(ranked) >= 3:
+        # Only stack the sharp end of the burst, blurred frames would soften the result
+        return median_stack([frame for _, frame in ranked[:max(3, stack_size)]]), best_score
+    return best_frame, best_score
@@ -0,0 +1,140 @@
+"""
+Shared-memory frame transport between the web process and analysis workers.
+
+The web process owns a pool of `multiprocessing.shared_memory` segments. A
+decoded frame is copied into a free segment once, and only a small `FrameRef`
+(segment name, shape, dtype) crosses the process boundary. Workers map the
+segment as a NumPy view, so multi-megabyte frames are never pickled. Overlays
+come back the same way through a second segment reserved for the job.
+
+Segments are created lazily and replaced by a larger one when a bigger frame
+arrives, so the pool only holds as much memory as the frames it has seen. No
+segment grows past the pool's `max_bytes`: larger frames, such as full
+resolution uploads, are pickled to the worker instead, so a few of them cannot
+pin hundreds of megabytes of /dev/shm for the life of the process.
+"""
+import threading
+from collections import namedtuple, OrderedDict
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# What a worker needs to map a frame: segment name, capacity, array shape and dtype
+FrameRef = namedtuple('FrameRef', ['name', 'capacity', 'shape', 'dtype'])
+
+# Segments attached in this (worker) process, by name, least recently used first
+_attached = OrderedDict()
+# Segments replaced by a larger one are unlinked by the web process; drop our
+# mapping of them once this many others have been used since
+MAX_ATTACHED = 32
+
+
+class FramePool:
+    """A fixed number of reusable shared-memory slots."""
+
+    def __init__(self, slots, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._segments = [None] * slots
+        self._free = list(range(slots))
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def acquire(self):
+        """Reserve a free slot and return its index, or None if all are in use."""
+        with self._lock:
+            return self._free.pop() if self._free else None
+
+    def release(self, slot):
+        with self._lock:
+            self._free.append(slot)
+
+    def _segment(self, slot, size):
+        if self.closed:
+            raise ValueError("Frame pool is closed")
+        segment = self._segments[slot]
+        if segment is None or segment.size < size:
+            if segment is not None:
+                segment.close()
+                segment.unlink()
+            segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            self._segments[slot] = segment
+        return segment
+
+    def _fits(self, nbytes):
+        return self.max_bytes is None or nbytes <= self.max_bytes
+
+    def reserve(self, slot, nbytes):
+        """
+        Make sure `slot` can hold `nbytes` and return an empty ref for a worker
+        to fill. Past `max_bytes` the ref has no room, and `put` declines it.
+        """
+        if not self._fits(nbytes):
+            return FrameRef(None, 0, None, None)
+        segment = self._segment(slot, nbytes)
+        return FrameRef(segment.name, segment.size, None, None)
+
+    def write(self, slot, frame):
+        """
+        Copy `frame` into `slot` and return the ref to hand to a worker, or
+        the frame itself, to be pickled, if it is larger than `max_bytes`.
+        """
+        frame = np.ascontiguousarray(frame)
+        if not self._fits(frame.nbytes):
+            return frame
+        segment = self._segment(slot, frame.nbytes)
+        np.ndarray(frame.shape, dtype=frame.dtype, buffer=segment.buf)[...] = frame
+        return FrameRef(segment.name, segment.size, frame.shape, frame.dtype.str)
+
+    def read(self, slot, ref):
+        """View of the frame a worker wrote into `slot`. Valid until the slot is released."""
+        return np.ndarray(ref.shape, dtype=np.dtype(ref.dtype), buffer=self._segments[slot].buf)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            for segment in self._segments:
+                if segment is not None:
+                    segment.close()
+                    segment.unlink()
+            self._segments = [None] * len(self._segments)
+
+
+# --- Worker side -----------------------------------------------------------
+
+def _attach(name):
+    segment = _attached.get(name)
+    if segment is not None:
+        _attached.move_to_end(name)
+        return segment
+    try:
+        # Python 3.13+: the web process owns the segment, don't track it here
+        segment = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        segment = shared_memory.SharedMemory(name=name)
+    _attached[name] = segment
+    while len(_attached) > MAX_ATTACHED:
+        _, stale = _attached.popitem(last=False)
+        try:
+            stale.close()
+        except BufferError:
+            pass
+    return segment
+
+
+def view(ref):
+    """Map the frame described by `ref` as a NumPy array, without copying. A pickled frame is returned as is."""
+    if isinstance(ref, np.ndarray):
+        return ref
+    return np.ndarray(ref.shape, dtype=np.dtype(ref.dtype), buffer=_attach(ref.name).buf)
+
+
+def put(ref, frame):
+    """
+    Copy `frame` into the reserved segment described by `ref`.
+    Returns the filled-in ref, or None if the frame does not fit.
+    """
+    frame = np.ascontiguousarray(frame)
+    if frame.nbytes > ref.capacity:
+        return None
+    np.ndarray(frame.shape, dtype=frame.dtype, buffer=_attach(ref.name).buf)[...] = frame
+    return ref._replace(shape=frame.shape, dtype=frame.dtype.str)
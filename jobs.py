@@ -0,0 +1,427 @@
+"""
+Asynchronous analysis jobs.
+
+Analyses run in a bounded pool of worker processes instead of on Flask request
+threads, so simultaneous requests cannot oversubscribe the Pi's cores and the
+GIL is not shared with the web server. Submitting returns a job id right away;
+callers poll or long-poll the job for its result, or follow its progress
+events. When the queue is full, `submit` raises `QueueFull` so the route can
+answer 429 with Retry-After. If a worker process dies (out of memory, or a
+crash in OpenCV), the pool is broken for good; `submit` then replaces it and
+raises `PoolRestarted` so the route can answer 503 with Retry-After.
+
+Frames travel to the workers, and overlays back, through shared memory (see
+frame_pool.py); only small references are pickled, except for frames larger
+than config.FRAME_SLOT_MAX_BYTES. Vector overlays are small and come back
+with the result instead. Workers report stage progress over a multiprocessing queue; a pump thread in the web process
+appends the events to their job and wakes any subscribers.
+"""
+import os
+import time
+import math
+import uuid
+import logging
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, BrokenExecutor
+
+import config
+import frame_pool
+import metrics
+from analysis import OVERLAY_PREFIXES, GRAIN_CLASSES
+
+logger = logging.getLogger('jobs')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Shared-memory slots for job frames, two per admissible job (input, overlay)
+_frames = None
+
+# Progress events from the workers: (job_id, event) tuples
+_events_queue = None
+# Set in each worker process by _init_worker
+_worker_events = None
+
+# job_id -> job dict, guarded by _cond
+_jobs = {}
+_cond = threading.Condition()
+
+# Rolling average of job durations, used for Retry-After
+_avg_job_seconds = 2.0
+
+
+class QueueFull(Exception):
+    """Raised when the analysis queue has no free slots."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Analysis queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class PoolRestarted(Exception):
+    """Raised when a worker process died and the pool had to be replaced."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Analysis workers are restarting, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+# --- Worker side -----------------------------------------------------------
+
+def _init_worker(events):
+    """Runs once in each worker process."""
+    global _worker_events
+    import cv2
+    # One OpenCV thread per worker, the pool itself provides the parallelism
+    cv2.setNumThreads(1)
+    _worker_events = events
+
+
+def _emit(job_id, stage, **info):
+    """Send a progress event for `job_id` back to the web process."""
+    info["stage"] = stage
+    info["time"] = time.time()
+    try:
+        _worker_events.put_nowait((job_id, info))
+    except Exception:
+        pass  # Progress is best effort, never fail the analysis over it
+
+
+# Stage that ends at each boundary event
+_STAGE_ENDED_BY = {
+    "preprocess": "preprocess",
+    "segmentation": "segmentation",
+    "overlay": "classification",
+    "end": "overlay",
+}
+
+
+def _run_job(job_id, grain_type, frame_ref, overlay_ref):
+    """
+    Worker entry point: analyse the frame in shared memory.
+    Returns the result dict, the overlay (as a shared-memory ref when it fits
+    the reserved segment, otherwise as an array) and the time spent per stage.
+    Without an `overlay_ref` the job is in vector mode, and the vector overlay
+    is added to the result as "overlay_vector" instead.
+    """
+    from analysis import PIPELINES
+
+    marks = [("start", time.monotonic())]
+
+    def progress(stage, **info):
+        if stage in _STAGE_ENDED_BY:
+            marks.append((stage, time.monotonic()))
+        _emit(job_id, stage, **info)
+
+    image = frame_pool.view(frame_ref)
+    overlay, result = PIPELINES[grain_type](image, progress=progress, vector=overlay_ref is None)
+    progress("overlay")
+    if overlay_ref is None:
+        result["overlay_vector"] = overlay
+        overlay = None
+    else:
+        overlay = frame_pool.put(overlay_ref, overlay) or overlay
+    marks.append(("end", time.monotonic()))
+
+    stage_seconds = {_STAGE_ENDED_BY[stage]: ended - started
+                     for (_, started), (stage, ended) in zip(marks, marks[1:])}
+    return result, overlay, stage_seconds
+
+
+def _warm_job(grain_type):
+    """Worker entry point: run a pipeline once on a synthetic frame."""
+    from analysis import PIPELINES
+    from warmup import synthetic_tray
+    PIPELINES[grain_type](synthetic_tray())
+    return os.getpid()
+
+
+# --- Web process side ------------------------------------------------------
+
+def _pump_events(events):
+    """Move worker progress events onto their jobs and wake subscribers."""
+    while True:
+        try:
+            item = events.get()
+        except (EOFError, OSError):
+            return
+        if item is None:  # The pool was replaced
+            return
+        job_id, event = item
+        with _cond:
+            job = _jobs.get(job_id)
+            if job is None:
+                continue
+            if job["status"] == "queued":
+                job["status"] = "running"
+            job["events"].append(event)
+            _cond.notify_all()
+
+
+def _get_executor():
+    """The worker pool and its frame slots, started on first use; read together so a restart cannot split them."""
+    global _executor, _events_queue, _frames
+    with _executor_lock:
+        if _executor is None:
+            _frames = frame_pool.FramePool(2 * config.ANALYSIS_QUEUE_SIZE, max_bytes=config.FRAME_SLOT_MAX_BYTES)
+            # Workers are forked from a clean server process so they never
+            # inherit the camera handle or the web server's threads.
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else None
+            context = multiprocessing.get_context(method)
+            _events_queue = context.Queue()
+            _executor = ProcessPoolExecutor(
+                max_workers=config.ANALYSIS_WORKERS,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(_events_queue,),
+            )
+            threading.Thread(target=_pump_events, args=(_events_queue,), daemon=True).start()
+            logger.info(f"Started analysis pool with {config.ANALYSIS_WORKERS} workers")
+        return _executor, _frames
+
+
+def _replace_executor(broken):
+    """Drop a broken pool, its frame slots and its event queue; the next job starts new ones."""
+    global _executor, _events_queue, _frames
+    with _executor_lock:
+        if _executor is not broken:
+            return  # Another thread got here first
+        logger.error("An analysis worker died, restarting the pool")
+        frames, events = _frames, _events_queue
+        _executor = _events_queue = _frames = None
+    broken.shutdown(wait=False, cancel_futures=True)
+    events.put(None)
+    # Jobs still in flight fail with BrokenExecutor and release their slots without reading them
+    frames.close()
+
+
+def warm_pool(grain_type):
+    """Run `grain_type`'s pipeline once in each worker process."""
+    executor, _ = _get_executor()
+    futures = [executor.submit(_warm_job, grain_type) for _ in range(config.ANALYSIS_WORKERS)]
+    return sorted({future.result() for future in futures})
+
+
+def _active_count():
+    return sum(1 for job in _jobs.values() if job["status"] in ("queued", "running"))
+
+
+def _retry_after():
+    waves = max(1, math.ceil(_active_count() / config.ANALYSIS_WORKERS))
+    return max(1, math.ceil(waves * _avg_job_seconds))
+
+
+def _prune_finished():
+    cutoff = time.time() - config.JOB_RESULT_TTL_SECONDS
+    for job_id in [job_id for job_id, job in _jobs.items()
+                   if job["finished_at"] is not None and job["finished_at"] < cutoff]:
+        del _jobs[job_id]
+
+
+def _on_done(job_id, executor, frames, slots, overlays, on_complete, future):
+    global _avg_job_seconds
+    with _cond:
+        grain_type = _jobs[job_id]["grain_type"]
+
+    error = future.exception()
+    if isinstance(error, BrokenExecutor):
+        # Replace the pool now rather than failing the next submit
+        _replace_executor(executor)
+    result = None
+    stage_seconds = {}
+    try:
+        if error is None:
+            result, overlay, stage_seconds = future.result()
+            if isinstance(overlay, frame_pool.FrameRef):
+                # The slot is reused once released, the writer gets its own copy
+                overlay = frames.read(slots[1], overlay).copy()
+            if overlay is not None:
+                result["processed_filename"] = overlays.submit(OVERLAY_PREFIXES[grain_type], overlay)
+            del overlay
+    except Exception as e:
+        error = e
+    finally:
+        for slot in slots:
+            frames.release(slot)
+
+    if error is None and on_complete is not None:
+        try:
+            on_complete(result)
+        except Exception as e:
+            logger.error(f"Completion hook for job {job_id} failed: {e}")
+    with _cond:
+        job = _jobs.get(job_id)
+        if job is None:
+            return
+        job["finished_at"] = time.time()
+        if error is None:
+            job["status"] = "done"
+            job["result"] = result
+            elapsed = job["finished_at"] - job["submitted_at"]
+            _avg_job_seconds = 0.8 * _avg_job_seconds + 0.2 * elapsed
+        else:
+            job["status"] = "failed"
+            job["error"] = str(error)
+            logger.warning(f"Analysis job {job_id} failed: {error}")
+        _cond.notify_all()
+        status = job["status"]
+        elapsed = job["finished_at"] - job["submitted_at"]
+    _record_metrics(grain_type, status, elapsed, stage_seconds, result)
+
+
+def _record_metrics(grain_type, status, elapsed, stage_seconds, result):
+    metrics.analysis_jobs.inc(pipeline=grain_type, status=status)
+    if status != "done":
+        return
+    metrics.analysis_latency.observe(elapsed, pipeline=grain_type)
+    for stage, seconds in stage_seconds.items():
+        metrics.stage_latency.observe(seconds, pipeline=grain_type, stage=stage)
+    for field, grain_class in GRAIN_CLASSES[grain_type].items():
+        count = result.get(field, 0)
+        if count:
+            metrics.grains_classified.inc(count, pipeline=grain_type, **{"class": grain_class})
+
+
+def submit(grain_type, image, overlays, on_complete=None, block=0, overlay_mode="image"):
+    """
+    Queue an analysis of the BGR `image` and return its job id.
+    The overlay is handed to the `overlays` OverlayWriter, so the job is done
+    as soon as the counts are known. With `overlay_mode` "vector" no overlay
+    image is drawn; the result carries the per-grain geometry instead.
+    `on_complete` is called with the result in the web process before the job
+    is reported as done. With `block` > 0, wait up to that many seconds for a
+    free queue slot instead of failing straight away.
+
+    Raises:
+        ValueError: If `grain_type` is not a known pipeline or `overlay_mode`
+            is not a known mode.
+        QueueFull: If `config.ANALYSIS_QUEUE_SIZE` jobs are still pending.
+        PoolRestarted: If a worker process had died; the pool is replaced.
+    """
+    from analysis import PIPELINES, OVERLAY_MODES
+    if grain_type not in PIPELINES:
+        raise ValueError(f"Unknown grain type: {grain_type}")
+    if overlay_mode not in OVERLAY_MODES:
+        raise ValueError(f"Unknown overlay mode: {overlay_mode}")
+
+    executor, frames = _get_executor()
+    with _cond:
+        _prune_finished()
+        deadline = time.monotonic() + block
+        while _active_count() >= config.ANALYSIS_QUEUE_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise QueueFull(_retry_after())
+            _cond.wait(remaining)
+        # Admission above guarantees two free slots
+        slots = (frames.acquire(), frames.acquire())
+        job_id = uuid.uuid4().hex
+        _jobs[job_id] = {
+            "id": job_id,
+            "grain_type": grain_type,
+            "status": "queued",
+            "result": None,
+            "error": None,
+            "submitted_at": time.time(),
+            "finished_at": None,
+            "events": [],
+            "future": None,
+        }
+    try:
+        frame_ref = frames.write(slots[0], image)
+        overlay_ref = None
+        if overlay_mode == "image":
+            # Overlays are drawn on a copy of the input, so they are the same size
+            overlay_ref = frames.reserve(slots[1], image.nbytes)
+        future = executor.submit(_run_job, job_id, grain_type, frame_ref, overlay_ref)
+    except Exception as e:
+        for slot in slots:
+            frames.release(slot)
+        with _cond:
+            del _jobs[job_id]
+            retry_after = _retry_after()
+        if isinstance(e, BrokenExecutor) or frames.closed:
+            # The pool broke, or another thread replaced it while this job was being submitted
+            _replace_executor(executor)
+            raise PoolRestarted(retry_after) from e
+        raise
+    with _cond:
+        _jobs[job_id]["future"] = future
+    future.add_done_callback(lambda f: _on_done(job_id, executor, frames, slots, overlays, on_complete, f))
+    return job_id
+
+
+def get_job(job_id, wait=0):
+    """
+    Return a snapshot of a job, or None if it is unknown.
+    With `wait` > 0, block up to that many seconds for the job to finish.
+    """
+    deadline = time.monotonic() + wait
+    with _cond:
+        while True:
+            job = _jobs.get(job_id)
+            if job is None:
+                return None
+            if job["status"] in ("queued", "running") and job["future"] is not None and job["future"].running():
+                job["status"] = "running"
+            remaining = deadline - time.monotonic()
+            if job["status"] in ("done", "failed") or remaining <= 0:
+                return _snapshot(job)
+            _cond.wait(remaining)
+
+
+def wait_any(job_ids, timeout=None):
+    """
+    Block until at least one of `job_ids` has finished, or `timeout` passes.
+    Returns the finished ids and the snapshots of those still known.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with _cond:
+        while True:
+            finished = [job_id for job_id in job_ids
+                        if _jobs.get(job_id) is None or _jobs[job_id]["status"] in ("done", "failed")]
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if finished or (remaining is not None and remaining <= 0):
+                return finished, [_snapshot(_jobs[job_id]) for job_id in finished if job_id in _jobs]
+            _cond.wait(remaining)
+
+
+def _snapshot(job):
+    return {key: value for key, value in job.items() if key not in ("future", "events")}
+
+
+def iter_events(job_id, heartbeat=15):
+    """
+    Yield a job's progress events as they arrive.
+
+    Yields None when nothing happened for `heartbeat` seconds, so streaming
+    callers can keep the connection alive. The last item is the finished job
+    snapshot, tagged as {"stage": "done", "job": ...}.
+    """
+    index = 0
+    while True:
+        with _cond:
+            job = _jobs.get(job_id)
+            if job is None:
+                return
+            if index >= len(job["events"]) and job["status"] not in ("done", "failed"):
+                _cond.wait(heartbeat)
+            pending = job["events"][index:]
+            index += len(pending)
+            finished = job["status"] in ("done", "failed")
+            snapshot = _snapshot(job) if finished else None
+        for event in pending:
+            yield event
+        if finished:
+            yield {"stage": "done", "job": snapshot}
+            return
+        if not pending:
+            yield None
+
+
+def queue_depth():
+    """Number of jobs queued or running."""
+    with _cond:
+        return _active_count()
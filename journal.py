@@ -0,0 +1,370 @@
+"""
+Append-only journal of saved results, one per grain type.
+
+Each saved result is one JSON line, {"seq": n, "data": {...}}, appended to the
+newest segment file of its grain type. Segment files are named after the first
+sequence number they hold, and a new one is started once a segment reaches
+`segment_bytes`. Concurrent appends are group-committed: every caller waits
+until its line is fsynced, but a single fsync covers all lines written up to
+that point.
+
+Uploaded results are not deleted one by one. The sync code acknowledges
+sequence numbers, and the journal persists a "synced up to" offset per grain
+type, which is the highest sequence number below which everything has been
+acknowledged. Segments that lie wholly under the offset are deleted by
+`compact()`.
+
+Only the app appends. Sync code in the app or in a separate daemon reads
+`pending()` records, `ack()`s them and compacts. A torn last line left by a
+crash is ignored by readers and truncated by the writer.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger('journal')
+
+SEGMENT_SUFFIX = ".jsonl"
+OFFSET_FILE = "synced_offset"
+# Legacy result files appended per fsync on start-up
+IMPORT_CHUNK_SIZE = 500
+
+
+def _fsync_directory(directory):
+    """Make renames and new files in `directory` durable."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class _Log:
+    """The segments and synced offset of one grain type."""
+
+    def __init__(self, directory, segment_bytes, commit_delay):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.commit_delay = commit_delay
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._file = None  # Open newest segment, writers only
+        self._file_bytes = 0
+        self._last_seq = None  # Highest sequence number written, writers only
+        self._durable = 0  # Highest sequence number fsynced
+        self._syncing = False
+        self._acked = set()  # Acknowledged sequence numbers above the offset
+
+    # --- Segments ----------------------------------------------------------
+
+    def segments(self):
+        """(first seq, path) of every segment, oldest first."""
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+                segments.append((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    @staticmethod
+    def _read_records(path, after=0):
+        """Complete records in a segment with seq > `after`; a torn last line is skipped."""
+        records = []
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.error(f"Skipping corrupt journal line in {path}")
+                    continue
+                if record["seq"] > after:
+                    records.append((record["seq"], record["data"]))
+        return records
+
+    def last_seq(self):
+        """Highest sequence number in the journal, 0 if it is empty."""
+        if self._last_seq is not None:
+            return self._last_seq
+        for first_seq, path in reversed(self.segments()):
+            records = self._read_records(path)
+            if records:
+                return records[-1][0]
+            # An empty newest segment still tells where numbering resumes
+            return first_seq - 1
+        return self.offset()
+
+    # --- Writing -----------------------------------------------------------
+
+    def _open_for_append(self):
+        segments = self.segments()
+        if segments:
+            path = segments[-1][1]
+            # Drop a torn last line left by a crash
+            with open(path, 'rb+') as f:
+                data = f.read()
+                end = data.rfind(b"\n") + 1
+                if end != len(data):
+                    logger.warning(f"Truncating torn record at the end of {path}")
+                    f.truncate(end)
+        self._last_seq = None
+        self._last_seq = max(self.last_seq(), self.offset())
+        if segments:
+            self._file = open(segments[-1][1], 'ab')
+            self._file_bytes = self._file.tell()
+        else:
+            self._start_segment()
+        self._durable = self._last_seq
+
+    def open_for_append(self):
+        with self._lock:
+            if self._file is None:
+                self._open_for_append()
+
+    def _start_segment(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._durable = self._last_seq
+        path = os.path.join(self.directory, f"{self._last_seq + 1:020d}{SEGMENT_SUFFIX}")
+        self._file = open(path, 'ab')
+        self._file_bytes = 0
+        _fsync_directory(self.directory)
+
+    def append(self, data):
+        """Append one record and return its sequence number once it is durable."""
+        return self.append_many([data])[-1]
+
+    def append_many(self, records):
+        """Append records and return their sequence numbers once all are durable, after a single fsync."""
+        seqs = []
+        with self._lock:
+            if self._file is None:
+                self._open_for_append()
+            for data in records:
+                if self._file_bytes >= self.segment_bytes:
+                    # An fsync in progress holds the current file; roll as soon as it is done
+                    while self._syncing:
+                        self._cond.wait()
+                    self._start_segment()
+                seq = self._last_seq + 1
+                line = (json.dumps({"seq": seq, "data": data}, separators=(",", ":")) + "\n").encode()
+                self._file.write(line)
+                self._file_bytes += len(line)
+                self._last_seq = seq
+                seqs.append(seq)
+        if not seqs:
+            return seqs
+        seq = seqs[-1]
+
+        # Group commit: one caller fsyncs for everyone who has written so far
+        while True:
+            with self._lock:
+                if self._durable >= seq:
+                    return seqs
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                self._syncing = True
+            target = None
+            try:
+                if self.commit_delay:
+                    time.sleep(self.commit_delay)  # Let concurrent saves join this commit
+                with self._lock:
+                    self._file.flush()
+                    fd = self._file.fileno()
+                    flushed = self._last_seq
+                os.fsync(fd)
+                target = flushed
+            finally:
+                with self._lock:
+                    if target is not None:
+                        self._durable = max(self._durable, target)
+                    self._syncing = False
+                    self._cond.notify_all()
+
+    # --- Reading and acknowledging -----------------------------------------
+
+    def _offset_path(self):
+        return os.path.join(self.directory, OFFSET_FILE)
+
+    def offset(self):
+        """Sequence number up to which every record has been synced."""
+        try:
+            with open(self._offset_path()) as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_offset(self, offset):
+        tmp_path = self._offset_path() + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._offset_path())
+        _fsync_directory(self.directory)
+
+    def pending(self, limit, after=0):
+        """Up to `limit` unsynced records with seq > `after`, oldest first, as (seq, data) pairs."""
+        offset = max(self.offset(), after)
+        with self._lock:
+            acked = set(self._acked)
+        records = []
+        segments = self.segments()
+        for index, (first_seq, path) in enumerate(segments):
+            # Skip segments that end before the offset
+            if index + 1 < len(segments) and segments[index + 1][0] <= offset + 1:
+                continue
+            try:
+                segment_records = self._read_records(path, after=offset)
+            except FileNotFoundError:
+                continue  # Compacted meanwhile
+            for seq, data in segment_records:
+                if seq not in acked:
+                    records.append((seq, data))
+                    if len(records) >= limit:
+                        return records
+        return records
+
+    def ack(self, seqs):
+        """Mark records as synced and persist the new contiguous offset."""
+        with self._lock:
+            offset = self.offset()
+            self._acked.update(seq for seq in seqs if seq > offset)
+            new_offset = offset
+            while new_offset + 1 in self._acked:
+                new_offset += 1
+                self._acked.discard(new_offset)
+            if new_offset != offset:
+                self._write_offset(new_offset)
+        return new_offset
+
+    def backlog(self):
+        """Number of records not yet synced."""
+        with self._lock:
+            acked = len(self._acked)
+        return max(0, self.last_seq() - self.offset() - acked)
+
+    def compact(self):
+        """Delete segments whose records are all synced. The newest segment is kept for appending."""
+        offset = self.offset()
+        segments = self.segments()
+        removed = 0
+        for (first_seq, path), (next_first_seq, _) in zip(segments, segments[1:]):
+            if next_first_seq - 1 <= offset:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        if removed:
+            _fsync_directory(self.directory)
+        return removed
+
+
+class ResultJournal:
+    """Journals for each grain type under one directory."""
+
+    def __init__(self, directory, grain_types=("rice", "dal"), segment_bytes=1024 * 1024, commit_delay=0.005):
+        self.directory = directory
+        self._logs = {grain_type: _Log(os.path.join(directory, grain_type), segment_bytes, commit_delay)
+                      for grain_type in grain_types}
+
+    def _log(self, grain_type):
+        if grain_type not in self._logs:
+            raise ValueError(f"Unknown grain type: {grain_type}")
+        return self._logs[grain_type]
+
+    def open_for_append(self):
+        """Open the newest segments for appending; only the app does this."""
+        for log in self._logs.values():
+            log.open_for_append()
+
+    def append(self, grain_type, data):
+        """Durably append a result and return its sequence number."""
+        return self._log(grain_type).append(data)
+
+    def append_many(self, grain_type, records):
+        """Durably append several results with one fsync and return their sequence numbers."""
+        return self._log(grain_type).append_many(records)
+
+    def pending(self, grain_type, limit=500, after=0):
+        return self._log(grain_type).pending(limit, after)
+
+    def ack(self, grain_type, seqs):
+        return self._log(grain_type).ack(seqs)
+
+    def fail(self, grain_type, seqs, error):
+        """The journal keeps no per-record sync state; failed records simply stay pending."""
+
+    def backlog(self, grain_type=None):
+        if grain_type is None:
+            return sum(log.backlog() for log in self._logs.values())
+        return self._log(grain_type).backlog()
+
+    def compact(self):
+        return sum(log.compact() for log in self._logs.values())
+
+    def last_saved(self):
+        """Newest sequence number of each grain type; changes only when a result is saved."""
+        return tuple(log.last_seq() for log in self._logs.values())
+
+    def watch_patterns(self):
+        """(directory, filename pattern) pairs whose files change when results are saved."""
+        return [(log.directory, "*" + SEGMENT_SUFFIX) for log in self._logs.values()]
+
+    def import_files(self, grain_type, storage_dir, transform=None, chunk_size=IMPORT_CHUNK_SIZE):
+        """
+        Move results saved as one JSON file each (the old layout) into the
+        journal, passing each through `transform` if given. The files are
+        appended `chunk_size` at a time with one fsync, and deleted once
+        their chunk is durable.
+        """
+        imported = 0
+        if not os.path.isdir(storage_dir):
+            return imported
+        names = sorted(name for name in os.listdir(storage_dir) if name.endswith(".json"))
+        for start in range(0, len(names), chunk_size):
+            paths, records = [], []
+            for name in names[start:start + chunk_size]:
+                path = os.path.join(storage_dir, name)
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                except Exception as e:
+                    logger.error(f"Could not import {path}: {e}")
+                    continue
+                paths.append(path)
+                records.append(transform(data) if transform else data)
+            self.append_many(grain_type, records)
+            for path in paths:
+                os.remove(path)
+            imported += len(paths)
+        if imported:
+            logger.info(f"Imported {imported} {grain_type} results into the journal")
+        return imported
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def open_journal(app_root_path):
+    """The process-wide journal under `app_root_path`'s local storage."""
+    import config
+    directory = os.path.join(app_root_path, config.LOCAL_STORAGE_DIR, 'journal')
+    with _journals_lock:
+        if directory not in _journals:
+            _journals[directory] = ResultJournal(directory, segment_bytes=config.JOURNAL_SEGMENT_BYTES,
+                                                 commit_delay=config.JOURNAL_COMMIT_DELAY_SECONDS)
+        return _journals[directory]
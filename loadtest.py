@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Load-test profile for the analyzer's web server.
+
+Replays a mix of what a few operators' browsers do, from a number of
+concurrent clients, and reports throughput and latency per route. Run it once
+against `python app.py` and once against `python serve.py` on the same device
+to compare the development and production servers.
+
+Usage:
+    python loadtest.py http://raspberrypi.local:5000 --clients 8 --duration 60 \\
+        --image-path /static/captured/captured_1748522574.jpg
+
+Profiles:
+    ui        page loads: index, the fingerprinted /assets/ URLs the index
+              page links to, /ready
+    analysis  /process_image on --image-path, the CPU-heavy path
+    mixed     ui traffic with one analysis per ten requests, plus an open
+              video feed per client if --with-video is given
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.request
+from collections import defaultdict
+
+PAGE_REQUESTS = [
+    ("GET", "/", None),
+    ("GET", "/ready", None),
+]
+ASSET_LINK = re.compile(r'(?:href|src)="(/assets/[^"]+)"')
+
+
+def ui_requests(base_url, timeout):
+    """Page requests plus the assets the index page links to, as a browser loads them."""
+    with urllib.request.urlopen(base_url + "/", timeout=timeout) as response:
+        page = response.read().decode(errors="replace")
+    assets = sorted(set(ASSET_LINK.findall(page)))
+    if not assets:
+        print("Warning: the index page links no /assets/ URLs")
+    return PAGE_REQUESTS + [("GET", path, None) for path in assets]
+
+
+def analysis_request(image_path):
+    return ("POST", "/process_image", {"image_path": image_path})
+
+
+def pick_request(profile, image_path, ui):
+    if profile == "analysis":
+        return analysis_request(image_path)
+    if profile == "mixed" and image_path and random.random() < 0.1:
+        return analysis_request(image_path)
+    return random.choice(ui)
+
+
+def send(base_url, method, path, body, timeout):
+    data = None
+    # What browsers send, so the precompressed variants are served
+    headers = {"Accept-Encoding": "gzip, deflate, br"}
+    if body is not None:
+        data = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+    request = urllib.request.Request(base_url + path, data=data, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def hold_video_feed(base_url, stop):
+    """Keep an MJPEG stream open, like a browser showing the live view."""
+    try:
+        with urllib.request.urlopen(base_url + "/video_feed", timeout=10) as response:
+            while not stop.is_set() and response.read(65536):
+                pass
+    except Exception:
+        pass
+
+
+def client(base_url, profile, image_path, ui, stop, stats, lock, timeout):
+    while not stop.is_set():
+        method, path, body = pick_request(profile, image_path, ui)
+        start = time.monotonic()
+        try:
+            status = send(base_url, method, path, body, timeout)
+        except Exception:
+            status = "error"
+        elapsed = time.monotonic() - start
+        with lock:
+            stats[(method, path)].append((elapsed, status))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(stats, duration):
+    total = sum(len(samples) for samples in stats.values())
+    print(f"\n{total} requests in {duration:.0f}s: {total / duration:.1f} req/s\n")
+    print(f"{'route':40} {'count':>7} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+    for (method, path), samples in sorted(stats.items()):
+        latencies = [elapsed for elapsed, _ in samples]
+        errors = sum(1 for _, status in samples if status == "error" or int(status) >= 500)
+        print(f"{method + ' ' + path:40} {len(samples):7} {len(samples) / duration:7.1f} "
+              f"{percentile(latencies, 0.5) * 1000:8.0f} {percentile(latencies, 0.95) * 1000:8.0f} {errors:7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the rice analyzer")
+    parser.add_argument("base_url")
+    parser.add_argument("--profile", choices=("ui", "analysis", "mixed"), default="mixed")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--image-path", help="Saved image to analyse, e.g. /static/captured/captured_1.jpg")
+    parser.add_argument("--with-video", action="store_true", help="Hold one /video_feed open per client")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    if args.profile == "analysis" and not args.image_path:
+        parser.error("--image-path is required for the analysis profile")
+
+    base_url = args.base_url.rstrip("/")
+    ui = ui_requests(base_url, args.timeout) if args.profile != "analysis" else []
+    stop = threading.Event()
+    stats = defaultdict(list)
+    lock = threading.Lock()
+    threads = []
+    for _ in range(args.clients):
+        threads.append(threading.Thread(
+            target=client, args=(base_url, args.profile, args.image_path, ui, stop, stats, lock, args.timeout)))
+        if args.with_video:
+            threads.append(threading.Thread(target=hold_video_feed, args=(base_url, stop)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    start = time.monotonic()
+    time.sleep(args.duration)
+    stop.set()
+    report(stats, time.monotonic() - start)
+
+
+if __name__ == "__main__":
+    main()
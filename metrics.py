@@ -0,0 +1,197 @@
+"""
+Prometheus-style metrics for the /metrics endpoint.
+
+Counters and histograms are updated on hot paths (every request, every frame,
+every job), so they never take a lock there. Each thread writes to its own
+shard, and the scrape sums the shards. Shards of threads that have exited are
+folded into a retired total whenever a new thread starts writing and at
+scrape time, so per-request threads do not leak even if nothing scrapes. Gauges are computed only when scraped.
+"""
+import bisect
+import threading
+import weakref
+
+# Latency buckets in seconds, from static files up to full analyses
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+class _ShardedMetric:
+    """Base for metrics whose samples are kept per writing thread."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._lock = threading.Lock()  # Only taken when a thread first writes and on scrape
+        self._shards = []  # (weakref to thread, shard dict)
+        self._retired = {}
+        _registry.append(self)
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {}
+            self._local.shard = shard
+            with self._lock:
+                self._retire_dead()
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+        return shard
+
+    def _retire_dead(self):
+        """Fold the shards of exited threads into the retired total; call with the lock held."""
+        live = []
+        for thread_ref, shard in self._shards:
+            thread = thread_ref()
+            if thread is None or not thread.is_alive():
+                # The thread can no longer write, fold its samples in for good
+                self._merge(self._retired, shard)
+            else:
+                live.append((thread_ref, shard))
+        self._shards = live
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _merge(self, into, shard):
+        raise NotImplementedError
+
+    def collect(self):
+        """Sum all shards into one {label values: value} dict."""
+        with self._lock:
+            self._retire_dead()
+            total = {}
+            self._merge(total, self._retired)
+            for _, shard in self._shards:
+                self._merge(total, shard)
+        return total
+
+
+class Counter(_ShardedMetric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def _merge(self, into, shard):
+        for key, value in list(shard.items()):
+            into[key] = into.get(key, 0) + value
+
+    def samples(self):
+        for key, value in self.collect().items():
+            yield self.name, key, value
+
+
+class Histogram(_ShardedMetric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        counts = shard.get(key)
+        if counts is None:
+            # One slot per bucket plus +Inf, then the sum
+            counts = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _merge(self, into, shard):
+        for key, counts in list(shard.items()):
+            merged = into.get(key)
+            if merged is None:
+                into[key] = list(counts)
+            else:
+                for i, value in enumerate(counts):
+                    merged[i] += value
+
+    def samples(self):
+        for key, counts in self.collect().items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", key + (_format_bound(bound),), cumulative
+            yield f"{self.name}_count", key, cumulative
+            yield f"{self.name}_sum", key, counts[-1]
+
+    def label_names(self, sample_name):
+        return self.labels + ("le",) if sample_name.endswith("_bucket") else self.labels
+
+
+class Gauge:
+    """A value computed at scrape time by `func`, which returns a number or {label values: number}."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, func, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.labels = tuple(labels)
+        _registry.append(self)
+
+    def samples(self):
+        value = self.func()
+        if value is None:
+            return
+        if isinstance(value, dict):
+            for key, item in value.items():
+                yield self.name, key if isinstance(key, tuple) else (key,), item
+        else:
+            yield self.name, (), value
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render():
+    """Render every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        try:
+            samples = list(metric.samples())
+        except Exception:
+            continue  # A failing gauge must not break the whole scrape
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for sample_name, key, value in samples:
+            names = metric.label_names(sample_name) if hasattr(metric, "label_names") else metric.labels
+            if names:
+                label_text = ",".join(f'{name}="{_escape(item)}"' for name, item in zip(names, key))
+                lines.append(f"{sample_name}{{{label_text}}} {value}")
+            else:
+                lines.append(f"{sample_name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# --- Metrics shared across modules -----------------------------------------
+
+http_requests = Counter("analyzer_http_requests_total", "HTTP requests by route, method and status",
+                        ("route", "method", "status"))
+http_latency = Histogram("analyzer_http_request_duration_seconds", "Time to produce a response, by route",
+                         ("route", "method"))
+analysis_jobs = Counter("analyzer_analysis_jobs_total", "Finished analysis jobs by pipeline and status",
+                        ("pipeline", "status"))
+analysis_latency = Histogram("analyzer_analysis_duration_seconds", "Job time from submission to result, by pipeline",
+                             ("pipeline",))
+stage_latency = Histogram("analyzer_analysis_stage_duration_seconds", "Time spent in each pipeline stage",
+                          ("pipeline", "stage"))
+grains_classified = Counter("analyzer_grains_classified_total", "Grains classified, by pipeline and class",
+                            ("pipeline", "class"))
+camera_frames = Counter("analyzer_camera_frames_total", "Frames streamed from the camera; rate() gives the FPS")
+sync_results = Counter("analyzer_sync_results_total", "Results uploaded to MongoDB")
+sync_bytes = Counter("analyzer_sync_bytes_total", "BSON bytes of results uploaded to MongoDB, before wire compression")
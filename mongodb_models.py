@@ -1,5 +1,19 @@
 from datetime import datetime
 
+# A result is identified by the device that saved it and the time it was saved
+RESULT_KEY = ("device_id", "timestamp")
+RESULT_INDEX_NAME = "device_id_timestamp"
+
+def ensure_result_index(collection):
+    """Unique index on RESULT_KEY, so uploading a result again cannot duplicate it."""
+    from pymongo import ASCENDING
+    collection.create_index([(field, ASCENDING) for field in RESULT_KEY], unique=True, name=RESULT_INDEX_NAME)
+
+def upsert_operation(document):
+    """Bulk operation inserting `document` unless a result with its key is stored; safe to retry."""
+    from pymongo import UpdateOne
+    return UpdateOne({field: document[field] for field in RESULT_KEY}, {"$setOnInsert": document}, upsert=True)
+
 def create_rice_document(data):
     """Create a MongoDB document for rice analysis results."""
     return {
@@ -37,4 +51,105 @@ def create_dal_document(data):
         "device_id": data.get("device_id", "unknown"),
         "timestamp": data.get("timestamp", datetime.now().strftime("%Y%m%d_%H%M%S_%f")),
         "created_at": datetime.now(),
-    }
\ No newline at end of file
+    }
+
+DOCUMENT_BUILDERS = {"rice": create_rice_document, "dal": create_dal_document}
+
+def stored_document(grain_type, data):
+    """The document for analysis results, JSON-ready for the local result store."""
+    document = DOCUMENT_BUILDERS[grain_type](data)
+    document["created_at"] = document["created_at"].isoformat()
+    return document
+
+# Compact schema (version 2). Counts are stored under short names and left out
+# when zero, the broken percentages are packed as [25%, 50%, 75%] and left out
+# when all zero, and `at` is the one BSON datetime, replacing created_at.
+# device_id and the string timestamp are kept exactly as in version 1, as they
+# are the key of the unique index: a result uploaded in either version then
+# matches the same key, and results saved within one millisecond stay apart.
+# Version 1 documents are the ones built by create_rice_document and
+# create_dal_document and carry no "v".
+SCHEMA_VERSION = 2
+TIMESTAMP_FORMAT = "%Y%m%d_%H%M%S_%f"
+SHORT_NAMES = {
+    "rice": {
+        "total_objects": "t", "full_grain_count": "f", "broken_grain_count": "b", "chalky_count": "c",
+        "black_count": "k", "yellow_count": "y", "brown_count": "w", "stone_count": "s", "husk_count": "h",
+    },
+    "dal": {"total_objects": "t", "full_grain_count": "f", "broken_grain_count": "b", "black_dal": "k"},
+}
+BROKEN_KEYS = ("25%", "50%", "75%")
+
+def compact_document(grain_type, document):
+    """The version 2 form of a version 1 document."""
+    try:
+        timestamp = datetime.strptime(document["timestamp"], TIMESTAMP_FORMAT)
+    except (TypeError, ValueError):
+        timestamp = document["created_at"]
+    compact = {"v": SCHEMA_VERSION, "device_id": document["device_id"], "timestamp": document["timestamp"],
+               "at": timestamp}
+    for name, short in SHORT_NAMES[grain_type].items():
+        if document.get(name):
+            compact[short] = document[name]
+    broken = [document.get("broken_percentages", {}).get(key, 0) for key in BROKEN_KEYS]
+    if any(broken):
+        compact["bp"] = broken
+    return compact
+
+def upload_document(grain_type, stored, version=None):
+    """
+    The MongoDB document for a record read from the local result store, in
+    schema `version` (config.RESULT_SCHEMA_VERSION by default). Records saved
+    before documents were stored hold the raw results, which are converted
+    here.
+    """
+    document = DOCUMENT_BUILDERS[grain_type](stored)
+    if isinstance(stored.get("created_at"), str):
+        document["created_at"] = datetime.fromisoformat(stored["created_at"])
+    if version is None:
+        import config
+        version = config.RESULT_SCHEMA_VERSION
+    return compact_document(grain_type, document) if version == SCHEMA_VERSION else document
+
+# Rollup documents: per device, grain type and hour, the number of results
+# and the sum and sum of squares of each count, so means and standard
+# deviations can be derived. Each bulk upload of results is one batch with a
+# unique id. Applying a batch to a rollup both increments it and adds the id
+# to its `batches`, and the update only matches rollups without that id, so
+# sending a batch again changes nothing.
+BROKEN_FIELDS = {"broken_25": "25%", "broken_50": "50%", "broken_75": "75%"}
+
+def rollup_hour(document):
+    """Start of the hour in which a version 1 document was saved."""
+    try:
+        saved = datetime.strptime(document["timestamp"], TIMESTAMP_FORMAT)
+    except (TypeError, ValueError):
+        saved = document["created_at"]
+    return saved.replace(minute=0, second=0, microsecond=0)
+
+def rollup_updates(grain_type, documents, batch_id):
+    """(filter, update) pairs adding version 1 documents to their hourly rollups as batch `batch_id`."""
+    buckets = {}
+    for document in documents:
+        key = (document["device_id"], rollup_hour(document))
+        increments = buckets.setdefault(key, {"results": 0})
+        increments["results"] += 1
+        values = {name: document.get(name, 0) for name in SHORT_NAMES[grain_type]}
+        values.update({name: document.get("broken_percentages", {}).get(key, 0)
+                       for name, key in BROKEN_FIELDS.items()})
+        for name, value in values.items():
+            increments[f"sum.{name}"] = increments.get(f"sum.{name}", 0) + value
+            increments[f"sumsq.{name}"] = increments.get(f"sumsq.{name}", 0) + value * value
+    updates = []
+    for (device_id, hour), increments in buckets.items():
+        rollup_id = f"{grain_type}:{device_id}:{hour.strftime('%Y%m%d%H')}"
+        updates.append((
+            {"_id": rollup_id, "batches": {"$ne": batch_id}},
+            {"$inc": increments, "$addToSet": {"batches": batch_id},
+             "$setOnInsert": {"grain_type": grain_type, "device_id": device_id, "hour": hour}}))
+    return updates
+
+def rollup_operation(query, update):
+    """Bulk operation applying a rollup update; inserts the rollup if it does not exist yet."""
+    from pymongo import UpdateOne
+    return UpdateOne(query, update, upsert=True)
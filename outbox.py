@@ -0,0 +1,379 @@
+"""
+SQLite outbox for saved results and their sync state.
+
+Every saved result is one row holding its MongoDB document (as built by
+mongodb_models) along with its sync status, the number of upload attempts,
+the last error and the time it was synced. The database runs in WAL mode, so
+the app's writes never block readers such as the sync engine or the history
+routes. Each thread gets its own connection, and all statements are fixed,
+parameterised SQL, so sqlite3's statement cache prepares each one only once
+per connection.
+
+The sync engine reads pending rows in batches through a partial index over
+the pending rows. Synced rows are kept for local history until they are
+older than the retention period.
+
+Hourly and daily rollups (counts and sums of each result field, bucketed by
+local time) are updated in the same transaction as each insert. Dashboard
+statistics therefore read one row per bucket instead of scanning results,
+and the rollups outlive the retention period.
+
+`ResultOutbox` has the same append/pending/ack/fail interface as the JSONL
+journal (journal.py), and `open_result_store` returns whichever store
+config.RESULT_STORE selects.
+"""
+import os
+import json
+import time
+import datetime
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger('outbox')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    grain_type TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    document TEXT NOT NULL,
+    saved_at REAL NOT NULL,
+    sync_status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    last_attempt_at REAL,
+    synced_at REAL,
+    UNIQUE (grain_type, device_id, timestamp)
+);
+CREATE INDEX IF NOT EXISTS results_pending ON results (grain_type, id) WHERE sync_status = 'pending';
+DROP INDEX IF EXISTS results_saved_at;
+CREATE INDEX IF NOT EXISTS results_history ON results (saved_at, id);
+CREATE TABLE IF NOT EXISTS rollups (
+    grain_type TEXT NOT NULL,
+    period TEXT NOT NULL,
+    bucket_start REAL NOT NULL,
+    results INTEGER NOT NULL,
+    total_objects INTEGER NOT NULL,
+    full_grain_count INTEGER NOT NULL,
+    broken_grain_count INTEGER NOT NULL,
+    chalky_count INTEGER NOT NULL,
+    black_count INTEGER NOT NULL,
+    yellow_count INTEGER NOT NULL,
+    brown_count INTEGER NOT NULL,
+    stone_count INTEGER NOT NULL,
+    husk_count INTEGER NOT NULL,
+    broken_percent_sum REAL NOT NULL,
+    PRIMARY KEY (grain_type, period, bucket_start)
+) WITHOUT ROWID;
+"""
+
+# Rollup periods, and the counts summed per bucket. Dal's black_dal is summed as black_count.
+PERIODS = ("hour", "day")
+ROLLUP_COUNTS = ("total_objects", "full_grain_count", "broken_grain_count", "chalky_count", "black_count",
+                 "yellow_count", "brown_count", "stone_count", "husk_count")
+ROLLUP_SUMS = ROLLUP_COUNTS + ("broken_percent_sum",)
+
+# Legacy results moved into the outbox per transaction on start-up
+IMPORT_CHUNK_SIZE = 500
+
+INSERT_RESULT = """
+INSERT OR IGNORE INTO results (grain_type, device_id, timestamp, document, saved_at)
+VALUES (?, ?, ?, ?, ?)
+"""
+SELECT_PENDING = """
+SELECT id, document FROM results
+WHERE grain_type = ? AND sync_status = 'pending' AND id > ?
+ORDER BY id LIMIT ?
+"""
+MARK_SYNCED = """
+UPDATE results SET sync_status = 'synced', synced_at = ?, last_attempt_at = ?, attempts = attempts + 1, last_error = NULL
+WHERE id = ?
+"""
+MARK_FAILED = """
+UPDATE results SET attempts = attempts + 1, last_attempt_at = ?, last_error = ?
+WHERE id = ?
+"""
+UPSERT_ROLLUP = f"""
+INSERT INTO rollups (grain_type, period, bucket_start, results, {", ".join(ROLLUP_SUMS)})
+VALUES (?, ?, ?, 1, {", ".join("?" for _ in ROLLUP_SUMS)})
+ON CONFLICT (grain_type, period, bucket_start) DO UPDATE SET
+results = results + 1, {", ".join(f"{name} = {name} + excluded.{name}" for name in ROLLUP_SUMS)}
+"""
+SELECT_HISTORY = """
+SELECT id, grain_type, saved_at, sync_status, attempts, last_error, document FROM results
+WHERE saved_at >= ? AND saved_at < ? AND (saved_at, id) < (?, ?) AND (? IS NULL OR grain_type = ?)
+ORDER BY saved_at DESC, id DESC LIMIT ?
+"""
+SELECT_ROLLUPS = f"""
+SELECT bucket_start, results, {", ".join(ROLLUP_SUMS)} FROM rollups
+WHERE grain_type = ? AND period = ? AND bucket_start >= ? AND bucket_start < ?
+ORDER BY bucket_start
+"""
+COUNT_PENDING = "SELECT COUNT(*) FROM results WHERE grain_type = ? AND sync_status = 'pending'"
+DELETE_SYNCED = "DELETE FROM results WHERE sync_status = 'synced' AND synced_at < ?"
+SELECT_ID = "SELECT id FROM results WHERE grain_type = ? AND device_id = ? AND timestamp = ?"
+LAST_ID = "SELECT seq FROM sqlite_sequence WHERE name = 'results'"
+
+
+def saved_time(document):
+    """Unix time at which a result was saved, from its timestamp field."""
+    try:
+        return datetime.datetime.strptime(document["timestamp"], "%Y%m%d_%H%M%S_%f").timestamp()
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+
+def bucket_start(saved_at, period):
+    """Start of the local-time hour or day holding `saved_at`."""
+    moment = datetime.datetime.fromtimestamp(saved_at).replace(minute=0, second=0, microsecond=0)
+    if period == "day":
+        moment = moment.replace(hour=0)
+    return moment.timestamp()
+
+
+def rollup_values(document):
+    """The values a result adds to its rollup buckets, in ROLLUP_SUMS order."""
+    counts = dict(document, black_count=document.get("black_count", document.get("black_dal", 0)))
+    values = [int(counts.get(name) or 0) for name in ROLLUP_COUNTS]
+    full, broken = counts.get("full_grain_count") or 0, counts.get("broken_grain_count") or 0
+    values.append(100.0 * broken / (full + broken) if full + broken else 0.0)
+    return values
+
+
+def rollup_summary(buckets):
+    """Totals over rollup buckets, with the average broken percentage and the chalky ratio."""
+    summary = {"results": sum(bucket["results"] for bucket in buckets)}
+    for name in ROLLUP_SUMS:
+        summary[name] = sum(bucket[name] for bucket in buckets)
+    broken_percent_sum = summary.pop("broken_percent_sum")
+    summary["average_broken_percent"] = broken_percent_sum / summary["results"] if summary["results"] else None
+    summary["chalky_ratio"] = (summary["chalky_count"] / summary["total_objects"]
+                               if summary["total_objects"] else None)
+    return summary
+
+
+class ResultOutbox:
+    """Results awaiting sync, and recently synced ones, in an SQLite database."""
+
+    def __init__(self, path, grain_types=("rice", "dal"), synchronous="FULL", retention_days=90):
+        self.path = path
+        self.grain_types = tuple(grain_types)
+        self.synchronous = synchronous
+        self.retention_days = retention_days
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+        self._rebuild_rollups()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, cached_statements=64)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.conn = conn
+        return conn
+
+    def _check(self, grain_type):
+        if grain_type not in self.grain_types:
+            raise ValueError(f"Unknown grain type: {grain_type}")
+
+    def open_for_append(self):
+        """Nothing to open; the journal needs this, the outbox does not."""
+
+    def _add_to_rollups(self, conn, grain_type, saved_at, document):
+        values = rollup_values(document)
+        conn.executemany(UPSERT_ROLLUP, [(grain_type, period, bucket_start(saved_at, period), *values)
+                                         for period in PERIODS])
+
+    def _rebuild_rollups(self):
+        """Fill the rollups from stored results when they are missing, e.g. in a database made before them."""
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM rollups LIMIT 1").fetchone() is not None:
+            return
+        with conn:
+            for grain_type, saved_at, document in conn.execute(
+                    "SELECT grain_type, saved_at, document FROM results").fetchall():
+                self._add_to_rollups(conn, grain_type, saved_at, json.loads(document))
+
+    def _insert(self, conn, grain_type, document):
+        saved_at = saved_time(document)
+        key = (grain_type, document.get("device_id", "unknown"), document["timestamp"])
+        cursor = conn.execute(INSERT_RESULT, (*key, json.dumps(document, separators=(",", ":")), saved_at))
+        if not cursor.rowcount:
+            # Stored before; lastrowid would be the id of an unrelated earlier insert
+            return conn.execute(SELECT_ID, key).fetchone()[0]
+        self._add_to_rollups(conn, grain_type, saved_at, document)
+        return cursor.lastrowid
+
+    def append(self, grain_type, document):
+        """Store a JSON-ready result document and return its row id once committed."""
+        self._check(grain_type)
+        conn = self._connection()
+        with conn:
+            return self._insert(conn, grain_type, document)
+
+    def append_many(self, grain_type, documents):
+        """Store several result documents in one transaction, so one commit (and fsync) covers them all."""
+        self._check(grain_type)
+        conn = self._connection()
+        with conn:
+            for document in documents:
+                self._insert(conn, grain_type, document)
+
+    def pending(self, grain_type, limit=500, after=0):
+        """Up to `limit` unsynced results with ids above `after`, oldest first, as (id, document) pairs."""
+        self._check(grain_type)
+        rows = self._connection().execute(SELECT_PENDING, (grain_type, after, limit)).fetchall()
+        return [(row_id, json.loads(document)) for row_id, document in rows]
+
+    def ack(self, grain_type, ids):
+        """Mark results as synced."""
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.executemany(MARK_SYNCED, [(now, now, row_id) for row_id in ids])
+
+    def fail(self, grain_type, ids, error):
+        """Record a failed upload attempt; the results stay pending."""
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.executemany(MARK_FAILED, [(now, str(error), row_id) for row_id in ids])
+
+    def watch_patterns(self):
+        """(directory, filename pattern) pairs whose files change when results are saved."""
+        return [(os.path.dirname(self.path), os.path.basename(self.path) + "*")]
+
+    def last_saved(self):
+        """Id of the newest result ever saved; changes only when a result is saved."""
+        row = self._connection().execute(LAST_ID).fetchone()
+        return row[0] if row else 0
+
+    def backlog(self, grain_type=None):
+        """Number of results not yet synced."""
+        conn = self._connection()
+        grain_types = self.grain_types if grain_type is None else (grain_type,)
+        return sum(conn.execute(COUNT_PENDING, (name,)).fetchone()[0] for name in grain_types)
+
+    def compact(self):
+        """Drop synced results past the retention period and checkpoint the WAL."""
+        conn = self._connection()
+        with conn:
+            removed = conn.execute(DELETE_SYNCED, (time.time() - self.retention_days * 86400,)).rowcount
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        return removed
+
+    def history(self, grain_type=None, since=0, until=None, limit=50, before=None):
+        """
+        Saved results, newest first, with their sync state. `before` is the
+        (saved_at, id) of the last result of the previous page; the second
+        value returned is the one for this page, or None on the last page.
+        """
+        if grain_type is not None:
+            self._check(grain_type)
+        until = time.time() + 86400 if until is None else until
+        before_saved_at, before_id = before if before else (until, 0)
+        rows = self._connection().execute(SELECT_HISTORY, (
+            since, until, before_saved_at, before_id, grain_type, grain_type, limit + 1)).fetchall()
+        results = [{
+            "id": row_id, "grain_type": row_grain_type, "saved_at": saved_at, "sync_status": sync_status,
+            "attempts": attempts, "last_error": last_error, "document": json.loads(document),
+        } for row_id, row_grain_type, saved_at, sync_status, attempts, last_error, document in rows[:limit]]
+        next_page = (results[-1]["saved_at"], results[-1]["id"]) if len(rows) > limit else None
+        return results, next_page
+
+    def rollups(self, grain_type, period="hour", since=0, until=None):
+        """Rollup buckets of one period overlapping the range, oldest first, as dicts of the result count and sums."""
+        self._check(grain_type)
+        if period not in PERIODS:
+            raise ValueError(f"Unknown period: {period}")
+        until = time.time() + 86400 if until is None else until
+        since = bucket_start(since, period) if since else 0
+        rows = self._connection().execute(SELECT_ROLLUPS, (grain_type, period, since, until)).fetchall()
+        return [dict(zip(("bucket_start", "results") + ROLLUP_SUMS, row)) for row in rows]
+
+    def status(self, grain_type):
+        """Counts per sync status, with the latest error of a still pending result."""
+        conn = self._connection()
+        counts = dict(conn.execute(
+            "SELECT sync_status, COUNT(*) FROM results WHERE grain_type = ? GROUP BY sync_status",
+            (grain_type,)).fetchall())
+        last_error = conn.execute(
+            "SELECT last_error FROM results WHERE grain_type = ? AND sync_status = 'pending' "
+            "AND last_error IS NOT NULL ORDER BY last_attempt_at DESC LIMIT 1", (grain_type,)).fetchone()
+        return {"pending": counts.get("pending", 0), "synced": counts.get("synced", 0),
+                "last_error": last_error[0] if last_error else None}
+
+    def import_files(self, grain_type, storage_dir, transform=None, chunk_size=IMPORT_CHUNK_SIZE):
+        """
+        Move results saved as one JSON file each (the oldest layout) into the
+        outbox, `chunk_size` files per transaction. The files of a chunk are
+        deleted once it is committed.
+        """
+        imported = 0
+        if not os.path.isdir(storage_dir):
+            return imported
+        names = sorted(name for name in os.listdir(storage_dir) if name.endswith(".json"))
+        for start in range(0, len(names), chunk_size):
+            paths, documents = [], []
+            for name in names[start:start + chunk_size]:
+                path = os.path.join(storage_dir, name)
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                except Exception as e:
+                    logger.error(f"Could not import {path}: {e}")
+                    continue
+                paths.append(path)
+                documents.append(transform(data) if transform else data)
+            self.append_many(grain_type, documents)
+            for path in paths:
+                os.remove(path)
+            imported += len(paths)
+        if imported:
+            logger.info(f"Imported {imported} {grain_type} results into the outbox")
+        return imported
+
+    def import_journal(self, journal, transform=None, chunk_size=IMPORT_CHUNK_SIZE):
+        """
+        Move results still pending in a JSONL journal into the outbox,
+        `chunk_size` per transaction; `transform` gets (grain_type, data).
+        """
+        imported = 0
+        for grain_type in self.grain_types:
+            while True:
+                records = journal.pending(grain_type, chunk_size)
+                if not records:
+                    break
+                self.append_many(grain_type, [transform(grain_type, data) if transform else data
+                                              for _, data in records])
+                journal.ack(grain_type, [seq for seq, _ in records])
+                imported += len(records)
+        if imported:
+            journal.compact()
+            logger.info(f"Imported {imported} results from the journal into the outbox")
+        return imported
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_result_store(app_root_path):
+    """The process-wide result store selected by config.RESULT_STORE ("sqlite" or "journal")."""
+    import config
+    if config.RESULT_STORE == "journal":
+        from journal import open_journal
+        return open_journal(app_root_path)
+    if config.RESULT_STORE != "sqlite":
+        raise ValueError(f"Unknown result store: {config.RESULT_STORE}")
+    path = os.path.join(app_root_path, config.LOCAL_STORAGE_DIR, 'outbox.db')
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = ResultOutbox(path, synchronous=config.OUTBOX_SYNCHRONOUS,
+                                         retention_days=config.OUTBOX_RETENTION_DAYS)
+        return _stores[path]
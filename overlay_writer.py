@@ -0,0 +1,103 @@
+"""
+Background encoding of processed overlay images.
+
+Analysis results are returned as soon as the counts are known. The overlay is
+handed to a single writer thread, which resizes it to the configured maximum
+dimension, encodes it (JPEG or WebP) and writes it to the processed folder.
+Freshly encoded overlays are kept in a small in-memory cache, so the browser's
+follow-up request is served without reading the file back. A request that
+arrives before encoding has finished waits for it.
+"""
+import os
+import queue
+import logging
+import threading
+from collections import OrderedDict
+
+import cv2
+
+logger = logging.getLogger('overlay_writer')
+
+FORMATS = {
+    # format: (extension, mimetype, quality flag)
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
+class OverlayWriter:
+    """Encodes and writes overlays on a background thread."""
+
+    def __init__(self, retention, image_format="jpeg", quality=90, max_dimension=None, cache_size=8):
+        if image_format not in FORMATS:
+            raise ValueError(f"Unsupported overlay format: {image_format}")
+        self.retention = retention
+        self.extension, self.mimetype, quality_flag = FORMATS[image_format]
+        self.params = [quality_flag, int(quality)]
+        self.max_dimension = max_dimension
+        self.cache_size = cache_size
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = {}  # filename -> threading.Event set once written (or failed)
+        self._cache = OrderedDict()  # filename -> encoded bytes, oldest first
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, prefix, image):
+        """
+        Queue `image` for encoding and return the filename it will be written as.
+        The caller must not modify `image` afterwards.
+        """
+        filename = self.retention.new_filename(prefix, self.extension)
+        with self._lock:
+            self._pending[filename] = threading.Event()
+        self._queue.put((filename, image))
+        return filename
+
+    def _resize(self, image):
+        height, width = image.shape[:2]
+        if not self.max_dimension or max(height, width) <= self.max_dimension:
+            return image
+        scale = self.max_dimension / max(height, width)
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    def _run(self):
+        while True:
+            filename, image = self._queue.get()
+            data = None
+            try:
+                ok, encoded = cv2.imencode(self.extension, self._resize(image), self.params)
+                if not ok:
+                    raise IOError("Encoding failed")
+                data = encoded.tobytes()
+                with open(os.path.join(self.retention.directory, filename), 'wb') as f:
+                    f.write(data)
+                # Evicts the oldest processed images over the retention limits
+                self.retention.add(filename)
+            except Exception as e:
+                logger.error(f"Could not write overlay {filename}: {e}")
+                self.retention.discard(filename)
+                data = None
+            with self._lock:
+                if data is not None:
+                    self._cache[filename] = data
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+                event = self._pending.pop(filename)
+            event.set()
+
+    def get(self, filename, timeout=30):
+        """
+        Return the encoded bytes of a recent overlay, waiting for it if it is
+        still being encoded. Returns None if it is not cached, so the caller
+        should fall back to the file on disk.
+        """
+        with self._lock:
+            data = self._cache.get(filename)
+            event = self._pending.get(filename)
+        if data is not None or event is None:
+            return data
+        event.wait(timeout)
+        with self._lock:
+            return self._cache.get(filename)
@@ -2,23 +2,50 @@
 import cv2
 import numpy as np
 
+import vector_overlay
 
+# Report classification progress every this many grains
+PROGRESS_EVERY = 25
 
-def detect_and_count_rice_grains(original_image):
+# Outline colour (BGR) of each grain class on the overlay
+CLASS_COLOURS = {
+    "broken": (0, 0, 255),
+    "yellow": (0, 255, 255),
+    "chalky": (255, 255, 255),
+    "full": (0, 255, 0),
+}
+
+
+def _outline(visualization, shape, contours, grain_class):
+    """Outline a classified grain on the overlay, or record its class in its vector shape."""
+    if shape is not None:
+        shape["class"] = grain_class  # Like on the image, the last outline drawn wins
+    else:
+        cv2.drawContours(visualization, contours, -1, CLASS_COLOURS[grain_class], thickness=2)
+
+
+def detect_and_count_rice_grains(original_image, progress=None, vector=False):
     """
     Detects and counts rice grains in an image using watershed segmentation.
     
     Args:
         original_image (numpy array): Input image containing rice grains.
+        progress (callable, optional): Called as progress(stage, **info) after
+            preprocessing and segmentation, and periodically during
+            classification with the partial counts.
+        vector (bool, optional): Return the annotations as a vector overlay
+            (see vector_overlay.py) instead of drawing them on a copy.
         
     Returns:
-        tuple: Processed image, full grain count, broken grain count, and average rice area.
+        tuple: Processed image (or vector overlay), full grain count, broken grain count,
+        chalky, black and yellow counts, and the broken size breakdown.
     """
     if original_image is None:
         raise ValueError("Could not read image")
     
     # Create a copy of the original image for visualization
-    visualization_copy = original_image.copy()
+    visualization_copy = None if vector else original_image.copy()
+    grain_shapes = []
     
     # original_image = adjust_brightness_contrast_saturation(original_image)
     # Convert to HSV for processing 
@@ -38,6 +65,9 @@ def detect_and_count_rice_grains(original_image):
     # Add closing operation to fill small holes
     cleaned_image = cv2.morphologyEx(cleaned_image, cv2.MORPH_CLOSE, morphological_kernel, iterations=1)
 
+    if progress:
+        progress("preprocess")
+
     # Background extraction
     background = cv2.dilate(cleaned_image, morphological_kernel, iterations=2)
     
@@ -65,6 +95,8 @@ def detect_and_count_rice_grains(original_image):
     # Count unique regions (excluding background and boundaries)
     unique_markers = np.unique(markers)
     total_grain_count = len(unique_markers) - 2  # Subtract background and boundary
+    if progress:
+        progress("segmentation", regions=total_grain_count)
     
     # Initialize counters and storage for full and broken grains
     full_grain_count = 0
@@ -82,10 +114,16 @@ def detect_and_count_rice_grains(original_image):
     # Dictionary to store contour numbers and their RGB values
     contour_data = {}
     contour_number = 1
+    processed_labels = 0
     # Classify grains as full or broken based on shape and size
     for label in unique_markers:
         if label <= 1:  # Skip background and boundary
             continue
+        processed_labels += 1
+        if progress and processed_labels % PROGRESS_EVERY == 0:
+            progress("classification", processed=processed_labels, regions=len(unique_markers) - 2,
+                     full_grain_count=full_grain_count, broken_grain_count=broken_grain_count,
+                     chalky_count=chalky_count, yellow_count=yellow_count)
         grain_mask = np.zeros(grayscale_image.shape, dtype="uint8")
         grain_mask[markers == label] = 255
         contours, _ = cv2.findContours(grain_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -132,8 +170,13 @@ def detect_and_count_rice_grains(original_image):
                 eccentricity = 0
 
             # Draw contour number on the image
-            cv2.putText(visualization_copy, str(contour_number), (cX, cY),
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
+            shape = None
+            if vector:
+                shape = vector_overlay.grain_shape(contours[0], centroid=(cX, cY), label=contour_number)
+                grain_shapes.append(shape)
+            else:
+                cv2.putText(visualization_copy, str(contour_number), (cX, cY),
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
 
             contour_number += 1
 
@@ -154,26 +197,26 @@ def detect_and_count_rice_grains(original_image):
                     broken_50_count += 1
                 else:
                     broken_75_count += 1
-                cv2.drawContours(visualization_copy, contours, -1, (0, 0, 255), thickness=2)
+                _outline(visualization_copy, shape, contours, "broken")
 
             # 4. Yellow rice
             if count_for_yellow >= 8:
                 yellow_count += 1 + grain_multiplier
-                cv2.drawContours(visualization_copy, contours, -1, (0, 255, 255), thickness=2)
+                _outline(visualization_copy, shape, contours, "yellow")
 
             # 5. Chalky rice
             elif count_for_chalky >= 6:
                 chalky_count += 1 + grain_multiplier
-                cv2.drawContours(visualization_copy, contours, -1, (255, 255, 255), thickness=2)
+                _outline(visualization_copy, shape, contours, "chalky")
 
             # 6. Full grain rice
             elif eccentricity >= 0.84 and area > 0.75 * average_rice_area:
                 if(chalky_count >= 1):
                     chalky_count += 1 + grain_multiplier
-                    cv2.drawContours(visualization_copy, contours, -1, (255, 255, 255), thickness=2)
+                    _outline(visualization_copy, shape, contours, "chalky")
                     continue
                 full_grain_count += 1 + grain_multiplier
-                cv2.drawContours(visualization_copy, contours, -1, (0, 255, 0), thickness=2)
+                _outline(visualization_copy, shape, contours, "full")
 
             percentage_list = {
                 '25%': broken_25_count,
@@ -181,6 +224,9 @@ def detect_and_count_rice_grains(original_image):
                 '75%': broken_75_count
             }
     
+    if vector:
+        visualization_copy = vector_overlay.build(original_image, "outline", CLASS_COLOURS, grain_shapes)
+
     return (
         visualization_copy,
         full_grain_count,
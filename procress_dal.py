@@ -2,7 +2,29 @@ import cv2
 import numpy as np
 import math
 
-def process_dal(img):
+import vector_overlay
+
+# Report classification progress every this many contours
+PROGRESS_EVERY = 25
+
+# Fill colour (BGR) of each grain class on the visualization
+CLASS_COLOURS = {
+    "ignored": (128, 128, 128),
+    "black": (30, 30, 30),
+    "broken": (0, 0, 255),
+    "full": (0, 255, 0),
+}
+
+def process_dal(img, progress=None, display_width=800, vector=False):
+    """
+    Detects, counts and classifies dal grains on a blue background.
+
+    `progress`, if given, is called as progress(stage, **info) after masking,
+    after contour detection and periodically during classification. The
+    visualization is resized to `display_width` pixels wide; pass None to get
+    it at full size. With `vector`, the visualization is returned as a
+    vector overlay (see vector_overlay.py) in full-size coordinates instead.
+    """
     MIN_DAL_AREA = 200 # 250
     GOOD_DAL_MIN_AREA = 720
     GOOD_DAL_MAX_AREA = 1500
@@ -27,10 +49,15 @@ def process_dal(img):
     # Morphological opening to remove noise
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
     dal_mask = cv2.morphologyEx(dal_mask, cv2.MORPH_OPEN, kernel, iterations=2)
+    if progress:
+        progress("preprocess")
 
     # Find contours
     contours, _ = cv2.findContours(dal_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    output_img = img.copy()
+    output_img = None if vector else img.copy()
+    grain_shapes = []
+    if progress:
+        progress("segmentation", regions=len(contours))
 
     # Counters
     good_dal_count = 0
@@ -42,6 +69,10 @@ def process_dal(img):
     broken_75=0
 
     for i, contour in enumerate(contours):
+        if progress and i and i % PROGRESS_EVERY == 0:
+            progress("classification", processed=i, regions=len(contours),
+                     full_grain_count=good_dal_count, broken_grain_count=broken_dal_count,
+                     black_dal=black_spots_count)
         area = cv2.contourArea(contour)
         if area < MIN_DAL_AREA:
             continue
@@ -71,10 +102,12 @@ def process_dal(img):
             color = (128, 128, 128)  # Gray
             gray_dal_count += 1
             label = "Large (Ignored)"
+            grain_class = "ignored"
         elif count_for_black>10:
             black_spots_count+=1
             color=(30,30,30)
             label ="black"
+            grain_class = "black"
         elif (area < GOOD_DAL_MIN_AREA or
             solidity < BROKEN_SOLIDITY_THRESHOLD or
             circularity < BROKEN_CIRCULARITY_THRESHOLD or
@@ -88,11 +121,13 @@ def process_dal(img):
             color = (0, 0, 255)  # Red for Broken
             broken_dal_count += 1
             label = "Broken"
+            grain_class = "broken"
         
         else:
             color = (0, 255, 0)  # Green for Good
             good_dal_count += 1
             label = "Good"
+            grain_class = "full"
 
         # --- Shrink contour inward by 3 pixels ---
         contour_mask = np.zeros(img.shape[:2], dtype=np.uint8)
@@ -101,12 +136,19 @@ def process_dal(img):
         inner_contours, _ = cv2.findContours(eroded_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
         for inner_contour in inner_contours:
-            cv2.drawContours(output_img, [inner_contour], -1, color, cv2.FILLED)
+            if vector:
+                grain_shapes.append(vector_overlay.grain_shape(inner_contour, grain_class))
+            else:
+                cv2.drawContours(output_img, [inner_contour], -1, color, cv2.FILLED)
 
     # Print summary
     total_dal_count = good_dal_count + broken_dal_count + gray_dal_count
     # Show final result
-    display_img = cv2.resize(output_img, (800, int(output_img.shape[0] * (800 / output_img.shape[1]))))
+    display_img = output_img
+    if vector:
+        display_img = vector_overlay.build(img, "fill", CLASS_COLOURS, grain_shapes)
+    elif display_width:
+        display_img = cv2.resize(output_img, (display_width, int(output_img.shape[0] * (display_width / output_img.shape[1]))))
     broken_percent = {
         "25%": broken_25,
         "50%": broken_50,
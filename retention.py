@@ -0,0 +1,87 @@
+"""
+Retention of captured and processed images.
+
+The image directory is listed once, at startup. After that, an in-memory index
+ordered from oldest to newest is updated on every write. Enforcing the count
+and byte limits then only pops the oldest entries, instead of listing and
+stat-ing the whole directory on every capture and analysis, which gets slow
+on an SD card as the directory grows.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+class RetentionIndex:
+    """Keeps at most `max_files` files and `max_bytes` bytes in `directory`."""
+
+    def __init__(self, directory, max_files=None, max_bytes=None, extensions=('.jpg',)):
+        self.directory = directory
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.extensions = extensions
+        self._files = OrderedDict()  # filename -> size in bytes, oldest first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(self.extensions):
+                    stat = entry.stat()
+                    entries.append((stat.st_ctime, entry.name, stat.st_size))
+        entries.sort()  # Oldest first, as the old ctime-sorted cleanup did
+        with self._lock:
+            for _, name, size in entries:
+                self._files[name] = size
+                self._bytes += size
+            self._evict_locked()
+
+    def new_filename(self, prefix, extension='.jpg'):
+        """
+        Return an unused `<prefix>_<unix time><extension>` name.
+        Names written within the same second get a `_<n>` suffix instead of
+        overwriting each other.
+        """
+        stem = f"{prefix}_{int(time.time())}"
+        with self._lock:
+            name = f"{stem}{extension}"
+            counter = 1
+            while name in self._files or os.path.exists(os.path.join(self.directory, name)):
+                name = f"{stem}_{counter}{extension}"
+                counter += 1
+            # Reserve the name until the file is added
+            self._files[name] = 0
+            return name
+
+    def add(self, filename):
+        """Record a file that was just written and evict the oldest ones over the limits."""
+        size = os.path.getsize(os.path.join(self.directory, filename))
+        with self._lock:
+            self._bytes += size - self._files.pop(filename, 0)
+            self._files[filename] = size
+            self._evict_locked()
+
+    def discard(self, filename):
+        """Forget a reserved or written name without deleting anything."""
+        with self._lock:
+            self._bytes -= self._files.pop(filename, 0)
+
+    def _evict_locked(self):
+        while self._files and (
+                (self.max_files is not None and len(self._files) > self.max_files) or
+                (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            name, size = self._files.popitem(last=False)
+            self._bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Number of files and total bytes currently retained."""
+        with self._lock:
+            return {"files": len(self._files), "bytes": self._bytes}
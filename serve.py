@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Production entry point for the analyzer.
+
+Serves the Flask app with waitress instead of the Werkzeug development server
+(which `python app.py` runs, debugger included). Everything stays in a single
+process so the camera has exactly one owner; CPU-heavy analysis already runs
+in the job worker processes.
+
+The server's thread pool is split into lanes: long-lived streams (MJPEG, SSE,
+batch results), static files, analysis requests and everything else. Each
+lane is capped at its share of the threads, so a few open video feeds cannot
+starve page loads or analysis submissions. A request to a full lane is
+answered 503 at once rather than waiting, because a waiting request would
+itself occupy a thread from the shared pool. Lane sizes come from config.py.
+
+Usage:
+    python serve.py [--host 0.0.0.0] [--port 5000]
+"""
+import sys
+import argparse
+import threading
+from urllib.parse import parse_qs
+
+import config
+
+# Route prefixes per lane, everything else goes to the "default" lane
+LANE_PREFIXES = (
+    ("stream", ("/video_feed", "/batch")),
+    ("static", ("/static/", "/assets/", "/processed/")),
+    ("analysis", ("/process_image", "/process_dal", "/analyze_upload", "/jobs")),
+)
+
+
+def is_long_poll(query_string):
+    """Whether a job status request waits for the job (?wait= above 0)."""
+    try:
+        return float(parse_qs(query_string).get("wait", ["0"])[0]) > 0
+    except ValueError:
+        return False
+
+
+def lane_for(method, path, query_string=""):
+    """Return the lane a request belongs to."""
+    if path.startswith("/jobs/") and path.endswith("/events"):
+        return "stream"
+    if path.startswith("/jobs/") and method == "GET":
+        # Long polls, the UI's fallback when SSE fails, hold their thread like a stream does
+        return "stream" if is_long_poll(query_string) else "default"
+    for lane, prefixes in LANE_PREFIXES:
+        if path.startswith(prefixes):
+            return lane
+    return "default"
+
+
+class LaneLimiter:
+    """WSGI middleware giving each lane its own bounded share of server threads."""
+
+    def __init__(self, app, lane_sizes):
+        self.app = app
+        self.lanes = {lane: threading.BoundedSemaphore(size) for lane, size in lane_sizes.items()}
+
+    def __call__(self, environ, start_response):
+        lane = lane_for(environ.get("REQUEST_METHOD", "GET"), environ.get("PATH_INFO", ""),
+                        environ.get("QUERY_STRING", ""))
+        semaphore = self.lanes[lane]
+        # Never wait for a slot: the waiting would hold a server thread that belongs to the other lanes
+        if not semaphore.acquire(blocking=False):
+            start_response("503 Service Unavailable", [
+                ("Content-Type", "text/plain"),
+                ("Retry-After", "2"),
+            ])
+            return [f"Too many {lane} requests".encode()]
+        try:
+            body = self.app(environ, start_response)
+        except Exception:
+            semaphore.release()
+            raise
+        # Streaming bodies hold their lane until the client is done with them
+        return _ReleasingIterable(body, semaphore.release)
+
+
+class _ReleasingIterable:
+    def __init__(self, iterable, release):
+        self.iterable = iterable
+        self.release = release
+        self.released = False
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, "close"):
+                self.iterable.close()
+        finally:
+            if not self.released:
+                self.released = True
+                self.release()
+
+
+def lane_sizes():
+    return {
+        "stream": config.SERVE_STREAM_THREADS,
+        "static": config.SERVE_STATIC_THREADS,
+        "analysis": config.SERVE_ANALYSIS_THREADS,
+        "default": config.SERVE_DEFAULT_THREADS,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the rice analyzer in production mode")
+    parser.add_argument("--host", default=config.SERVE_HOST)
+    parser.add_argument("--port", type=int, default=config.SERVE_PORT)
+    args = parser.parse_args()
+
+    try:
+        from waitress import serve
+    except ImportError:
+        print("waitress is not installed, run: pip install waitress")
+        sys.exit(1)
+
+    import app as analyzer
+
+    analyzer.ensure_loopback_available()
+    analyzer.start_background_services()
+
+    sizes = lane_sizes()
+    # One server thread per lane slot, so every lane's share is really available
+    threads = sum(sizes.values())
+    print(f"Serving on {args.host}:{args.port} with {threads} threads {sizes}")
+    serve(
+        LaneLimiter(analyzer.app, sizes),
+        host=args.host,
+        port=args.port,
+        threads=threads,
+        connection_limit=config.SERVE_CONNECTION_LIMIT,
+        channel_timeout=config.SERVE_CHANNEL_TIMEOUT,
+        ident="rice-analyzer",
+    )
+
+
+if __name__ == "__main__":
+    main()
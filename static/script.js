@@ -31,11 +31,40 @@ let dalResults = {
 // Track what was last analyzed
 let lastAnalyzed = null; // 'rice' or 'dal'
 
+// Poll the server warm-up state until the camera and pipelines are ready
+function pollReady() {
+  const statusEl = document.getElementById('readyStatus');
+  fetch("/ready")
+    .then(response => response.json())
+    .then(data => {
+      if (data.done) {
+        const camera = data.components.camera;
+        if (camera && camera.state === 'failed') {
+          statusEl.textContent = "Camera unavailable";
+          statusEl.classList.remove('d-none');
+        } else {
+          statusEl.classList.add('d-none');
+        }
+        return;
+      }
+      const pending = Object.entries(data.components)
+        .filter(([name, info]) => info.state !== 'ready' && info.state !== 'failed')
+        .map(([name, info]) => name.replace('_', ' '));
+      statusEl.textContent = "Warming up: " + pending.join(", ");
+      statusEl.classList.remove('d-none');
+      setTimeout(pollReady, 1000);
+    })
+    .catch(() => setTimeout(pollReady, 2000));
+}
+
+document.addEventListener('DOMContentLoaded', pollReady);
+
 function captureImage() {
   fetch("/capture", { method: "POST" })
     .then(response => response.json())
     .then(data => {
       if (data.image_url) {
+        clearOverlay();
         document.getElementById('displayImage').src = data.image_url + "?t=" + new Date().getTime();
         document.getElementById('retakeButton').classList.remove('d-none');
       }
@@ -44,6 +73,7 @@ function captureImage() {
 }
 
 function retakeImage() {
+  clearOverlay();
   document.getElementById('displayImage').src = "/video_feed";
   document.getElementById('retakeButton').classList.add('d-none');
 }
@@ -83,6 +113,131 @@ function resetDalResults() {
   };
 }
 
+// Human readable label for a job progress event
+function describeProgress(event) {
+  switch (event.stage) {
+    case 'preprocess':
+      return "Preprocessing...";
+    case 'segmentation':
+      return `Segmenting: ${event.regions} regions found`;
+    case 'classification':
+      return `Classifying ${event.processed}/${event.regions}: ` +
+        `${event.full_grain_count} full, ${event.broken_grain_count} broken`;
+    case 'overlay':
+      return "Drawing overlay...";
+    default:
+      return "";
+  }
+}
+
+// Hide the grain annotations drawn over the capture
+function clearOverlay() {
+  const canvas = document.getElementById('overlayCanvas');
+  canvas.getContext('2d').clearRect(0, 0, canvas.width, canvas.height);
+  canvas.classList.add('d-none');
+}
+
+// Draw a vector overlay (per-grain geometry from the server) over the capture.
+// The canvas has the analysed image's size and is scaled like the image.
+function drawOverlay(overlay) {
+  const canvas = document.getElementById('overlayCanvas');
+  canvas.width = overlay.width;
+  canvas.height = overlay.height;
+  const ctx = canvas.getContext('2d');
+  ctx.lineWidth = 2;
+  ctx.font = "12px sans-serif";
+
+  overlay.grains.forEach(grain => {
+    const points = grain.points;
+    if (grain.class && points.length >= 4) {
+      ctx.beginPath();
+      ctx.moveTo(points[0], points[1]);
+      for (let i = 2; i < points.length; i += 2) {
+        ctx.lineTo(points[i], points[i + 1]);
+      }
+      ctx.closePath();
+      if (overlay.style === 'fill') {
+        ctx.fillStyle = overlay.colours[grain.class];
+        ctx.fill();
+      } else {
+        ctx.strokeStyle = overlay.colours[grain.class];
+        ctx.stroke();
+      }
+    }
+    if (grain.label !== undefined) {
+      ctx.fillStyle = "#ff0000";
+      ctx.fillText(String(grain.label), grain.centroid[0], grain.centroid[1]);
+    }
+  });
+  canvas.classList.remove('d-none');
+}
+
+// Show an analysis overlay: drawn locally for vector results, else the overlay image
+function showOverlay(data) {
+  if (data.overlay_vector) {
+    drawOverlay(data.overlay_vector);
+  } else if (data.processed_image_url) {
+    clearOverlay();
+    document.getElementById('displayImage').src = data.processed_image_url + "?t=" + new Date().getTime();
+  }
+}
+
+// Wait for a finished job with a long poll, used if the event stream drops
+function waitForJob(jobId) {
+  return fetch(`/jobs/${jobId}?wait=60`)
+    .then(response => response.json())
+    .then(job => {
+      if (job.status === 'done') {
+        return job.result;
+      }
+      if (job.status === 'failed') {
+        throw new Error(job.error);
+      }
+      return waitForJob(jobId);
+    });
+}
+
+// Queue an analysis job and follow its progress over Server-Sent Events.
+// Resolves with the same result object /process_image and /process_dal return.
+function runAnalysisJob(grainType, imagePath) {
+  const progressText = document.getElementById('progressText');
+  progressText.textContent = "Queued...";
+
+  return fetch("/jobs", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    // The capture is already on screen, so only the grain geometry is needed
+    body: JSON.stringify({ image_path: imagePath, grain_type: grainType, overlay: 'vector' })
+  })
+  .then(response => response.json().then(data => ({ ok: response.ok, data: data })))
+  .then(({ ok, data }) => {
+    if (!ok) {
+      throw new Error(data.error || "Could not start analysis");
+    }
+    return new Promise((resolve, reject) => {
+      const source = new EventSource(`/jobs/${data.job_id}/events`);
+      source.addEventListener('progress', e => {
+        progressText.textContent = describeProgress(JSON.parse(e.data));
+      });
+      source.addEventListener('result', e => {
+        source.close();
+        resolve(JSON.parse(e.data).result);
+      });
+      source.addEventListener('failed', e => {
+        source.close();
+        reject(new Error(JSON.parse(e.data).error));
+      });
+      source.onerror = () => {
+        source.close();
+        waitForJob(data.job_id).then(resolve, reject);
+      };
+    });
+  })
+  .finally(() => {
+    progressText.textContent = "";
+  });
+}
+
 function analyzeSelection() {
   // Reset dal results when analyzing rice
   resetDalResults();
@@ -96,16 +251,9 @@ function analyzeSelection() {
   let displayedImage = document.getElementById('displayImage').src;
   let imagePath = new URL(displayedImage, window.location.origin).pathname;
 
-  fetch("/process_image", {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ image_path: imagePath })
-  })
-  .then(response => response.json())
+  runAnalysisJob('rice', imagePath)
   .then(data => {
-    if (data.processed_image_url) {
-      document.getElementById('displayImage').src = data.processed_image_url + "?t=" + new Date().getTime();
-    }
+    showOverlay(data);
     
     // Set last analyzed type
     lastAnalyzed = 'rice';
@@ -217,16 +365,9 @@ function analyzeDal() {
   let displayedImage = document.getElementById('displayImage').src;
   let imagePath = new URL(displayedImage, window.location.origin).pathname;
 
-  fetch("/process_dal", {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ image_path: imagePath })
-  })
-  .then(response => response.json())
+  runAnalysisJob('dal', imagePath)
   .then(data => {
-    if (data.processed_image_url) {
-      document.getElementById('displayImage').src = data.processed_image_url + "?t=" + new Date().getTime();
-    }
+    showOverlay(data);
     
     // Set last analyzed type
     lastAnalyzed = 'dal';
@@ -0,0 +1,146 @@
+"""
+Fingerprinted, precompressed static assets.
+
+Each file under static/ (except the image folders) is hashed once at startup
+and served from /assets/ under a fingerprinted name, e.g.
+bootstrap.3f2a9c1d07.css. As the name changes whenever the content does, the
+browser may cache it for a year without revalidating. Text assets are
+compressed once (gzip, and brotli when the brotli package is installed), and
+each request gets the best encoding it accepts, straight from memory.
+
+Templates link assets with `asset_url('bootstrap.css')` instead of
+`url_for('static', ...)`. The plain /static/ URLs keep working.
+"""
+import os
+import gzip
+import hashlib
+import logging
+import mimetypes
+import threading
+from collections import namedtuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger('static_assets')
+
+# Only text compresses well, images and fonts are already compressed
+COMPRESSIBLE = ('.css', '.js', '.html', '.svg', '.json', '.txt', '.map')
+MIN_COMPRESS_BYTES = 1024
+FINGERPRINT_LENGTH = 10
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+Asset = namedtuple('Asset', ['filename', 'path', 'fingerprint', 'mimetype', 'url_name', 'stat'])
+
+
+def fingerprinted_name(filename, fingerprint):
+    """bootstrap.css -> bootstrap.<fingerprint>.css"""
+    root, extension = os.path.splitext(filename)
+    return f"{root}.{fingerprint}{extension}"
+
+
+class StaticAssets:
+    """Manifest of the static folder, with compressed variants held in memory."""
+
+    def __init__(self, directory, exclude=()):
+        self.directory = directory
+        self.exclude = tuple(exclude)
+        self._lock = threading.Lock()
+        self._variants = {}  # (fingerprinted name, encoding) -> bytes
+        self._assets = {}  # filename -> Asset
+        self._by_url_name = {}  # fingerprinted name -> Asset
+        self.scan()
+
+    def scan(self):
+        """
+        Hash every asset. Files whose size and mtime are unchanged since the
+        last scan keep their fingerprint and compressed variants, so a rescan
+        without edits only stat()s the folder.
+        """
+        previous = self._assets
+        assets = {}
+        for root, dirs, files in os.walk(self.directory):
+            relative_root = os.path.relpath(root, self.directory)
+            if relative_root == '.':
+                dirs[:] = [d for d in dirs if d not in self.exclude and not d.startswith('.')]
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                filename = os.path.normpath(os.path.join(relative_root, name)).replace(os.sep, '/')
+                stat = os.stat(path)
+                stat = (stat.st_mtime_ns, stat.st_size)
+                known = previous.get(filename)
+                if known is not None and known.stat == stat:
+                    assets[filename] = known
+                    continue
+                with open(path, 'rb') as f:
+                    fingerprint = hashlib.sha256(f.read()).hexdigest()[:FINGERPRINT_LENGTH]
+                mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                assets[filename] = Asset(filename, path, fingerprint, mimetype,
+                                         fingerprinted_name(filename, fingerprint), stat)
+        with self._lock:
+            self._assets = assets
+            self._by_url_name = {asset.url_name: asset for asset in assets.values()}
+            # Drop only the variants of files that changed or went away
+            self._variants = {key: data for key, data in self._variants.items() if key[0] in self._by_url_name}
+
+    def url_name(self, filename):
+        """Fingerprinted name of an asset, or the plain name if it is unknown."""
+        asset = self._assets.get(filename)
+        return asset.url_name if asset else filename
+
+    def lookup(self, url_name):
+        """Asset for a fingerprinted name, or None."""
+        return self._by_url_name.get(url_name)
+
+    def current(self, url_name):
+        """
+        Asset whose fingerprinted name differs from `url_name` only in the
+        fingerprint, e.g. one linked from a page loaded before an update.
+        """
+        root, extension = os.path.splitext(url_name)
+        root, _, fingerprint = root.rpartition('.')
+        if not root or len(fingerprint) != FINGERPRINT_LENGTH:
+            return None
+        return self._assets.get(root + extension)
+
+    def encodings(self, asset):
+        """Encodings available for an asset, best first; 'identity' always comes last."""
+        if asset.filename.endswith(COMPRESSIBLE) and os.path.getsize(asset.path) >= MIN_COMPRESS_BYTES:
+            return (('br',) if brotli else ()) + ('gzip', 'identity')
+        return ('identity',)
+
+    def variant(self, asset, encoding):
+        """Bytes of an asset in the given encoding, compressed on first use."""
+        key = (asset.url_name, encoding)
+        data = self._variants.get(key)
+        if data is not None:
+            return data
+        with open(asset.path, 'rb') as f:
+            data = f.read()
+        if encoding == 'gzip':
+            data = gzip.compress(data, compresslevel=9, mtime=0)
+        elif encoding == 'br':
+            data = brotli.compress(data, quality=11)
+        with self._lock:
+            self._variants[key] = data
+        return data
+
+    def precompress(self):
+        """Compress every asset now, so no page load pays for it."""
+        for asset in list(self._assets.values()):
+            for encoding in self.encodings(asset):
+                try:
+                    self.variant(asset, encoding)
+                except Exception as e:
+                    logger.error(f"Could not compress {asset.filename} as {encoding}: {e}")
+
+    def negotiate(self, asset, accept_encodings):
+        """Pick the best encoding the client accepts (a werkzeug Accept object)."""
+        for encoding in self.encodings(asset):
+            if encoding == 'identity' or accept_encodings[encoding]:
+                return encoding
+        return 'identity'
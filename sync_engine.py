@@ -0,0 +1,528 @@
+"""
+The MongoDB sync engine shared by the app (mongodb_sync.py) and the
+standalone daemon (mongo_sync_standalone.py).
+
+A pass uploads the result store's pending results in bulk upserts and
+acknowledges them in the store. Only one process may run a pass at a time:
+each pass first takes a lease, an exclusive fcntl lock on
+`local_storage/sync.lock`. When the app and the daemon both run, whichever
+asks second finds the lease taken and skips the pass instead of uploading
+the same results again. The lock is released by the kernel if its holder
+dies, so a crashed process never blocks syncing.
+
+With SYNC_MODE = "async", a pass keeps up to SYNC_MAX_IN_FLIGHT bulk writes
+in flight across the rice and dal collections instead of one at a time.
+
+With SYNC_UPLOAD = "rollups", results are not uploaded one document each.
+Instead they are folded into hourly rollup documents in ROLLUP_COLLECTION
+with $inc (see mongodb_models.rollup_updates). The results stay in the
+local store. Each batch's id and results are saved locally before its
+upload, so a batch interrupted by a crash is sent again unchanged and
+skipped by the rollups it already reached.
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+from pymongo.errors import ConnectionFailure, OperationFailure, BulkWriteError
+
+import config
+import metrics
+import connectivity
+from bandwidth import BatchSizer, ByteBudget, TransferStats, document_size
+from outbox import open_result_store
+from mongodb_models import ensure_result_index, upsert_operation, upload_document, rollup_updates, rollup_operation
+
+try:
+    import fcntl
+except ImportError:  # Not on POSIX; passes are then only serialized within a process
+    fcntl = None
+
+logger = logging.getLogger('sync_engine')
+
+LEASE_FILE = "sync.lock"
+BUDGET_FILE = "sync_budget.json"
+ROLLUP_PLAN_FILE = "rollup_batch.json"
+
+# Batch size follows the measured upload rate; see bandwidth.py
+batch_sizer = BatchSizer(config.SYNC_BATCH_SIZE, config.SYNC_MIN_BATCH_SIZE, config.SYNC_MAX_BATCH_SIZE,
+                         config.SYNC_TARGET_BATCH_SECONDS)
+transfer_stats = TransferStats()
+
+# Global MongoDB client
+_mongodb_client = None
+_last_connection_time = None
+# (client id, collection name) pairs whose unique index is known to exist
+_indexed_collections = set()
+
+def check_internet_connection():
+    """Whether the internet is reachable, from the shared connectivity monitor's cached answer."""
+    return connectivity.monitor().online()
+
+def validate_mongodb_connection(client):
+    """Validate if MongoDB connection is still alive."""
+    try:
+        # The ismaster command is cheap and does not require auth
+        client.admin.command('ismaster')
+        return True
+    except Exception:
+        return False
+
+def connect_to_mongodb():
+    """Connect to MongoDB and return client."""
+    global _mongodb_client, _last_connection_time
+    
+    # First check internet connection
+    if not check_internet_connection():
+        logger.warning("No internet connection detected, skipping MongoDB connection attempt")
+        return None
+    
+    # If client exists, check if connection is still valid
+    if _mongodb_client is not None:
+        if validate_mongodb_connection(_mongodb_client):
+            logger.debug("Reusing existing MongoDB connection")
+            return _mongodb_client
+        else:
+            # Close stale connection
+            try:
+                logger.info("Closing stale MongoDB connection")
+                _mongodb_client.close()
+            except:
+                pass
+            _mongodb_client = None
+    
+    # Create a new connection with shorter timeout
+    try:
+        logger.info("Attempting to connect to MongoDB...")
+        client = pymongo.MongoClient(
+            config.MONGO_URI, 
+            serverSelectionTimeoutMS=3000,  # Shorter timeout (3 seconds)
+            connectTimeoutMS=3000,
+            socketTimeoutMS=3000,
+            # Offered to the server, which picks the first it supports
+            compressors=config.MONGO_COMPRESSORS,
+            zlibCompressionLevel=config.MONGO_ZLIB_LEVEL
+        )
+        
+        # Quick validation check with timeout
+        client.admin.command('ismaster', serverSelectionTimeoutMS=3000)
+        
+        # Store the client and connection time
+        _mongodb_client = client
+        _last_connection_time = datetime.datetime.now()
+        logger.info("New MongoDB connection established successfully")
+        connectivity.monitor().report_success()
+        return client
+    except ConnectionFailure as e:
+        logger.error(f"MongoDB connection failure: {str(e)}")
+        connectivity.monitor().report_failure(e)
+        return None
+    except Exception as e:
+        logger.error(f"Error connecting to MongoDB: {str(e)}")
+        connectivity.monitor().report_failure(e)
+        return None
+
+class SyncLease:
+    """
+    Exclusive, non-blocking lease on syncing, held for one pass:
+
+        with SyncLease(path) as lease:
+            if lease.acquired:
+                ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.acquired = False
+        self._fd = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is None:
+            self.acquired = True
+            return self
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return self
+        self.acquired = True
+        # The holder's pid, for whoever wonders who is syncing
+        os.ftruncate(self._fd, 0)
+        os.write(self._fd, str(os.getpid()).encode())
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.acquired and fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+        self.acquired = False
+
+    def holder(self):
+        """Pid written by the current or last holder, or None."""
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0) or None
+        except (FileNotFoundError, ValueError):
+            return None
+
+def lease_path(app_root_path):
+    return os.path.join(app_root_path, config.LOCAL_STORAGE_DIR, LEASE_FILE)
+
+def record_transfer(synced, sent_bytes, seconds, backlog):
+    """Account for a pass's uploads in the transfer stats, metrics and log."""
+    transfer_stats.record_pass(synced, sent_bytes, seconds)
+    if synced:
+        metrics.sync_results.inc(synced)
+        metrics.sync_bytes.inc(sent_bytes)
+        status = transfer_stats.status(backlog)
+        logger.info(f"Sent {synced} results, {sent_bytes} bytes ({sent_bytes / synced:.0f} bytes/result) "
+                    f"in {seconds:.1f} s; batch size {batch_sizer.size}; "
+                    f"backlog {backlog}, drains in about {status['estimated_drain_seconds']} s")
+
+def close_client():
+    """Close the cached MongoDB client, e.g. on shutdown."""
+    global _mongodb_client
+    if _mongodb_client is not None:
+        try:
+            _mongodb_client.close()
+        except Exception:
+            pass
+        _mongodb_client = None
+
+def attempt_sync_to_mongodb(app_root_path):
+    """Attempt to sync data to MongoDB if internet is available."""
+    if not check_internet_connection():
+        logger.info("No internet connection available. Skipping MongoDB sync.")
+        return False
+    
+    return sync_data_to_mongodb(app_root_path)
+
+def ensure_indexes(collection):
+    """Create the unique result index once per collection and connection."""
+    key = (id(_mongodb_client), collection.full_name)
+    if key in _indexed_collections:
+        return
+    try:
+        ensure_result_index(collection)
+    except OperationFailure as e:
+        # Typically duplicates uploaded before the index existed; upserts still prevent new ones
+        logger.warning(f"Could not create unique index on {collection.full_name}: {str(e)}")
+    _indexed_collections.add(key)
+
+def upload_batch(collection, grain_type, batch):
+    """
+    Upload (seq, document) pairs in one unordered bulk upsert. Blocking.
+    Returns the seqs MongoDB stored, a {seq: error} dict of those it
+    rejected, and whether to go on with further batches; a write that was
+    not acknowledged fails the whole batch and stops the grain type.
+    The write's duration feeds the batch sizer.
+    """
+    started = time.monotonic()
+    try:
+        result = collection.bulk_write([upsert_operation(doc) for _, doc in batch], ordered=False)
+        batch_sizer.record(len(batch), time.monotonic() - started)
+        if not result.acknowledged:
+            logger.warning(f"MongoDB bulk write of {len(batch)} {grain_type} results not acknowledged")
+            return [], {seq: "bulk write not acknowledged" for seq, _ in batch}, False
+    except BulkWriteError as e:
+        batch_sizer.record(len(batch), time.monotonic() - started)
+        if e.details.get("writeConcernErrors"):
+            logger.warning(f"MongoDB bulk write of {len(batch)} {grain_type} results not acknowledged: {str(e)}")
+            return [], {seq: str(e) for seq, _ in batch}, False
+        # A duplicate key means the result is already stored, e.g. by a concurrent upsert
+        failed = {batch[error["index"]][0]: error.get("errmsg", "write error")
+                  for error in e.details.get("writeErrors", []) if error.get("code") != 11000}
+        if failed:
+            logger.error(f"{len(failed)} of {len(batch)} {grain_type} results failed to sync: {str(e)}")
+        return [seq for seq, _ in batch if seq not in failed], failed, True
+    except Exception:
+        batch_sizer.failed()  # Often a timeout on a slow link
+        raise
+    return [seq for seq, _ in batch], {}, True
+
+def record_batch(store, grain_type, synced, failed):
+    """Acknowledge a batch's stored results and record its failed ones, which stay pending."""
+    by_error = {}
+    for seq, message in failed.items():
+        by_error.setdefault(message, []).append(seq)
+    for message, seqs in by_error.items():
+        store.fail(grain_type, seqs, message)
+    if synced:
+        store.ack(grain_type, synced)
+        logger.info(f"Synced {len(synced)} {grain_type} results to MongoDB.")
+
+def pending_batch(store, grain_type, after, budget):
+    """
+    The next batch of (seq, document) pairs after `after`, sized by the batch
+    sizer and cut to what `budget` allows. Returns the batch, the size in
+    bytes of each document, reserved in the budget, and whether the budget
+    cut it short.
+    """
+    records = store.pending(grain_type, batch_sizer.size, after=after)
+    batch = [(seq, upload_document(grain_type, data)) for seq, data in records]
+    sizes = [document_size(document) for _, document in batch]
+    allowed = budget.take(sizes)
+    return batch[:allowed], sizes[:allowed], allowed < len(batch)
+
+def settle_batch(budget, batch, sizes, stored):
+    """Charge the budget for a batch's stored documents only and return their bytes."""
+    stored = set(stored)
+    sent_bytes = sum(size for (seq, _), size in zip(batch, sizes) if seq in stored)
+    budget.settle(sum(sizes), sent_bytes)
+    return sent_bytes
+
+def sync_records(collection, store, grain_type, budget):
+    """
+    Upload a grain type's pending results to `collection` in batches of
+    the batch sizer's size, one bulk upsert per batch. Results are acknowledged in
+    the result store only once their batch's write is acknowledged; failed
+    ones are recorded with their error and stay pending. Because the upserts
+    are keyed on device_id and timestamp, uploading a batch again after a
+    crash creates no duplicates.
+    Returns the number of results synced and the bytes sent.
+    """
+    ensure_indexes(collection)
+    synced = 0
+    sent_bytes = 0
+    after = 0
+    while True:
+        batch, sizes, capped = pending_batch(store, grain_type, after, budget)
+        if batch:
+            try:
+                stored, failed, proceed = upload_batch(collection, grain_type, batch)
+            except Exception:
+                settle_batch(budget, batch, sizes, ())
+                raise
+            sent_bytes += settle_batch(budget, batch, sizes, stored)
+            record_batch(store, grain_type, stored, failed)
+            synced += len(stored)
+        if not batch or capped or not proceed:
+            break
+        # Failed results are retried on the next pass
+        after = batch[-1][0]
+    return synced, sent_bytes
+
+async def sync_collections_async(collections, store, max_in_flight, budget):
+    """
+    Upload several grain types at once with up to `max_in_flight` bulk writes
+    in flight in total, so round trips overlap on slow links. pymongo calls
+    run on a bounded thread pool; the result store is only touched from the
+    event loop's thread. Each batch is acknowledged as soon as its own write
+    is, whatever the order in which batches complete.
+    `collections` maps grain type to collection. Returns the number of
+    results synced and the bytes sent; the first upload error is raised once
+    the other batches in flight have finished.
+    """
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_in_flight)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="sync-upload") as executor:
+        async def upload(collection, grain_type, batch, sizes):
+            stored = ()
+            try:
+                stored, failed, proceed = await loop.run_in_executor(
+                    executor, upload_batch, collection, grain_type, batch)
+            finally:
+                slots.release()
+                sent_bytes = settle_batch(budget, batch, sizes, stored)
+            record_batch(store, grain_type, stored, failed)
+            return len(stored), sent_bytes, proceed
+
+        async def drain(grain_type, collection):
+            await loop.run_in_executor(executor, ensure_indexes, collection)
+            in_flight = set()
+            synced = 0
+            sent_bytes = 0
+            after = 0
+            proceed = True
+            error = None
+            while proceed and error is None:
+                await slots.acquire()
+                batch, sizes, capped = pending_batch(store, grain_type, after, budget)
+                if not batch:
+                    slots.release()
+                    break
+                after = batch[-1][0]
+                proceed = not capped
+                in_flight.add(asyncio.ensure_future(upload(collection, grain_type, batch, sizes)))
+                # Stop reading ahead as soon as a finished batch says so
+                for task in [task for task in in_flight if task.done()]:
+                    in_flight.discard(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                    else:
+                        count, batch_bytes, batch_proceed = task.result()
+                        synced += count
+                        sent_bytes += batch_bytes
+                        proceed = proceed and batch_proceed
+            for outcome in await asyncio.gather(*in_flight, return_exceptions=True):
+                if isinstance(outcome, Exception):
+                    error = error or outcome
+                else:
+                    synced += outcome[0]
+                    sent_bytes += outcome[1]
+            if error is not None:
+                raise error
+            return synced, sent_bytes
+
+        counts = await asyncio.gather(*(drain(grain_type, collection) for grain_type, collection in collections.items()),
+                                      return_exceptions=True)
+    errors = [count for count in counts if isinstance(count, Exception)]
+    if errors:
+        raise errors[0]
+    return sum(synced for synced, _ in counts), sum(sent_bytes for _, sent_bytes in counts)
+
+def _save_plan(path, plan):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(plan, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _load_plan(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.error(f"Ignoring unreadable rollup batch {path}")
+        return None
+
+def _plan_records(store, plan):
+    """The plan's results that are still pending."""
+    seqs = set(plan["seqs"])
+    records = store.pending(plan["grain_type"], len(seqs), after=min(seqs) - 1)
+    return [(seq, data) for seq, data in records if seq in seqs]
+
+def upload_rollup_batch(collection, plan, records, budget):
+    """
+    Apply one planned batch of results to the rollups. Returns the bytes sent,
+    or None if the budget does not allow the batch now.
+    """
+    grain_type = plan["grain_type"]
+    documents = [upload_document(grain_type, data, version=1) for _, data in records]
+    updates = rollup_updates(grain_type, documents, plan["id"])
+    sent_bytes = sum(document_size({"q": query, "u": update}) for query, update in updates)
+    if not budget.take([sent_bytes]):
+        return None
+    started = time.monotonic()
+    try:
+        collection.bulk_write([rollup_operation(query, update) for query, update in updates], ordered=False)
+    except BulkWriteError as e:
+        # A duplicate _id is a rollup that already holds this batch
+        errors = [error for error in e.details.get("writeErrors", []) if error.get("code") != 11000]
+        if errors or e.details.get("writeConcernErrors"):
+            budget.settle(sent_bytes, 0)
+            raise
+    except Exception:
+        budget.settle(sent_bytes, 0)
+        batch_sizer.failed()
+        raise
+    budget.settle(sent_bytes, sent_bytes)
+    batch_sizer.record(len(records), time.monotonic() - started)
+    return sent_bytes
+
+def sync_rollups(collection, store, plan_path, budget):
+    """
+    Fold pending results into hourly rollups, one planned batch at a time.
+    An unfinished batch from an earlier pass goes first. Returns the number
+    of results synced and the bytes sent.
+    """
+    synced = 0
+    sent_bytes = 0
+    plan = _load_plan(plan_path)
+    grain_types = ["rice", "dal"]
+    while True:
+        if plan is None:
+            if not grain_types:
+                break
+            records = store.pending(grain_types[0], batch_sizer.size)
+            if not records:
+                grain_types.pop(0)
+                continue
+            plan = {"id": uuid.uuid4().hex, "grain_type": grain_types[0], "seqs": [seq for seq, _ in records]}
+            _save_plan(plan_path, plan)
+        else:
+            records = _plan_records(store, plan)
+        if records:
+            batch_bytes = upload_rollup_batch(collection, plan, records, budget)
+            if batch_bytes is None:
+                break  # Metered cap reached; the plan is kept for the next window
+            store.ack(plan["grain_type"], [seq for seq, _ in records])
+            synced += len(records)
+            sent_bytes += batch_bytes
+            logger.info(f"Rolled up {len(records)} {plan['grain_type']} results into MongoDB.")
+        os.remove(plan_path)
+        plan = None
+    return synced, sent_bytes
+
+def sync_data_to_mongodb(app_root_path):
+    """
+    Sync the result store's pending results to MongoDB, holding the sync
+    lease. Compact the store after a successful sync. Returns False without
+    connecting if another process holds the lease.
+    """
+    with SyncLease(lease_path(app_root_path)) as lease:
+        if not lease.acquired:
+            logger.info(f"Another process (pid {lease.holder()}) is syncing. Skipping sync.")
+            return False
+        return _sync_data_to_mongodb(app_root_path)
+
+def _sync_data_to_mongodb(app_root_path):
+    if config.SYNC_UPLOAD == "rollups" and config.RESULT_STORE != "sqlite":
+        # Compaction deletes synced journal segments, and rolled-up results would be lost with them
+        logger.error('SYNC_UPLOAD = "rollups" needs RESULT_STORE = "sqlite" to keep raw results. Skipping sync.')
+        return False
+
+    # Try to connect to MongoDB
+    client = connect_to_mongodb()
+    if client is None:
+        logger.warning("Could not connect to MongoDB. Skipping sync.")
+        return False
+    
+    try:
+        db = client[config.DB_NAME]
+        store = open_result_store(app_root_path)
+
+        collections = {"rice": db[config.RICE_COLLECTION], "dal": db[config.DAL_COLLECTION]}
+        budget = ByteBudget(os.path.join(app_root_path, config.LOCAL_STORAGE_DIR, BUDGET_FILE),
+                            config.SYNC_METERED_BYTES_PER_HOUR if config.SYNC_METERED else None)
+        started = time.monotonic()
+        if config.SYNC_UPLOAD == "rollups":
+            plan_path = os.path.join(app_root_path, config.LOCAL_STORAGE_DIR, ROLLUP_PLAN_FILE)
+            synced, sent_bytes = sync_rollups(db[config.ROLLUP_COLLECTION], store, plan_path, budget)
+        elif config.SYNC_MODE == "async":
+            synced, sent_bytes = asyncio.run(
+                sync_collections_async(collections, store, config.SYNC_MAX_IN_FLIGHT, budget))
+        else:
+            synced = sent_bytes = 0
+            for grain_type, collection in collections.items():
+                counts = sync_records(collection, store, grain_type, budget)
+                synced += counts[0]
+                sent_bytes += counts[1]
+        record_transfer(synced, sent_bytes, time.monotonic() - started, store.backlog())
+        if budget.remaining() == 0:
+            logger.info(f"Metered upload cap reached; the rest waits {budget.resets_in():.0f} s for the next window.")
+
+        # Drop synced journal segments, or synced outbox rows past retention
+        store.compact()
+        connectivity.monitor().report_success()
+        return True
+    except Exception as e:
+        logger.error(f"Error during MongoDB sync: {str(e)}")
+        connectivity.monitor().report_failure(e)
+        
+        # If there was a connection error, invalidate the client
+        close_client()
+        
+        return False
@@ -0,0 +1,157 @@
+"""
+The app's MongoDB sync worker.
+
+One long-lived thread owns syncing for the web process. Saving a result only
+posts a notification to its queue. The worker waits until notifications stop
+arriving for `debounce` seconds, or for at most `max_delay` seconds after the
+first one, and then runs a single sync pass for the whole burst. Passes never
+overlap, so two passes can no longer upload the same JSON file twice.
+
+When nothing is posted, the worker still runs a pass every `interval` seconds
+while results are waiting in the result store and the connectivity monitor
+says the cloud is reachable. A pass that failed offline is instead retried
+as soon as the monitor reports the connection is back. `status()` reports
+the worker's state to the rest of the app.
+"""
+import sys
+import time
+import queue
+import logging
+import threading
+
+from connectivity import ONLINE
+
+logger = logging.getLogger('sync_worker')
+
+# Notifications posted to the worker
+SAVED = "saved"  # A result was written to local storage
+SYNC_NOW = "sync_now"  # Run a pass without waiting for the debounce window
+
+
+class SyncWorker:
+    """Coalesces sync requests into passes run one at a time on a single thread."""
+
+    def __init__(self, app_root_path, store, interval=120, debounce=2.0, max_delay=10.0, connectivity=None):
+        self.app_root_path = app_root_path
+        self.store = store
+        self.connectivity = connectivity
+        self.interval = interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._events = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._state = {
+            "state": "stopped",  # stopped, idle, waiting (collecting a burst) or syncing
+            "pending_notifications": 0,
+            "passes": 0,
+            "notifications_coalesced": 0,
+            "last_attempt": None,
+            "last_success": None,
+            "last_result": None,  # "synced", "failed" or "error"
+            "last_error": None,
+        }
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._state["state"] = "idle"
+            self._thread = threading.Thread(target=self._run, name="sync-worker", daemon=True)
+            self._thread.start()
+        if self.connectivity is not None:
+            # Results saved offline are uploaded as soon as the connection returns
+            self.connectivity.add_listener(lambda: self.notify(SYNC_NOW))
+            self.connectivity.start()
+
+    def notify(self, event=SAVED):
+        """Ask for a sync pass. Never blocks; bursts are merged into one pass."""
+        with self._lock:
+            self._state["pending_notifications"] += 1
+        self._events.put(event)
+
+    def backlog(self):
+        """Number of results waiting in the result store."""
+        return self.store.backlog()
+
+    @property
+    def last_success(self):
+        """Unix time of the last pass that synced, or None."""
+        with self._lock:
+            return self._state["last_success"]
+
+    def status(self):
+        with self._lock:
+            status = dict(self._state)
+        status["backlog"] = self.backlog()
+        if self.connectivity is not None:
+            status["connectivity"] = self.connectivity.status()
+        engine = sys.modules.get('sync_engine')
+        if engine is not None:
+            status["transfer"] = engine.transfer_stats.status(status["backlog"])
+            status["batch_size"] = engine.batch_sizer.size
+        return status
+
+    def _set(self, **values):
+        with self._lock:
+            self._state.update(values)
+
+    def _collect_burst(self, first):
+        """Drain notifications until the burst goes quiet, returning how many there were."""
+        count = 1
+        urgent = first == SYNC_NOW
+        deadline = time.monotonic() + self.max_delay
+        while not urgent:
+            remaining = min(self.debounce, deadline - time.monotonic())
+            if remaining <= 0:
+                break
+            try:
+                event = self._events.get(timeout=remaining)
+            except queue.Empty:
+                break
+            count += 1
+            urgent = event == SYNC_NOW
+        # Anything posted up to now is covered by the coming pass
+        while True:
+            try:
+                self._events.get_nowait()
+                count += 1
+            except queue.Empty:
+                break
+        return count
+
+    def _run(self):
+        while True:
+            try:
+                first = self._events.get(timeout=self.interval)
+            except queue.Empty:
+                # Periodic retry, only worth a connection attempt if results are waiting
+                # and the cloud is reachable; otherwise the return of the connection triggers a pass
+                online = self.connectivity is None or self.connectivity.state == ONLINE
+                if online and self.backlog():
+                    self._sync_pass(0)
+                continue
+            self._set(state="waiting")
+            self._sync_pass(self._collect_burst(first))
+
+    def _sync_pass(self, notifications):
+        with self._lock:
+            self._state["pending_notifications"] = max(0, self._state["pending_notifications"] - notifications)
+            self._state["notifications_coalesced"] += notifications
+            self._state["state"] = "syncing"
+            self._state["last_attempt"] = time.time()
+        try:
+            # Imported here so the app still runs if pymongo is missing
+            import mongodb_sync
+            synced = mongodb_sync.attempt_sync_to_mongodb(self.app_root_path)
+            result, error = ("synced", None) if synced else ("failed", None)
+        except Exception as e:
+            logger.error(f"Sync pass failed: {e}")
+            result, error = "error", str(e)
+        with self._lock:
+            self._state["passes"] += 1
+            self._state["last_result"] = result
+            self._state["last_error"] = error
+            if result == "synced":
+                self._state["last_success"] = time.time()
+            self._state["state"] = "idle"
@@ -0,0 +1,48 @@
+"""
+Vector overlays: grain annotations as geometry instead of a second image.
+
+In vector mode the pipelines draw nothing. They describe each grain instead:
+its simplified contour, centroid, class and label. static/script.js draws
+these on a canvas over the capture the browser already shows, so the server
+skips copying, drawing and encoding a full-size overlay, and the browser
+does not download one.
+
+Coordinates are pixels of the analysed image. Contours are flattened to
+[x0, y0, x1, y1, ...] lists of ints to keep the JSON compact.
+"""
+import cv2
+
+# Tolerance of the contour simplification, in pixels
+CONTOUR_EPSILON = 1.0
+
+
+def grain_shape(contour, grain_class=None, centroid=None, label=None):
+    """Compact description of one grain; `grain_class` None means it was not classified."""
+    points = cv2.approxPolyDP(contour, CONTOUR_EPSILON, True)
+    shape = {"class": grain_class, "points": points.reshape(-1).tolist()}
+    if centroid is not None:
+        shape["centroid"] = [int(centroid[0]), int(centroid[1])]
+    if label is not None:
+        shape["label"] = label
+    return shape
+
+
+def css_colour(bgr):
+    blue, green, red = bgr
+    return f"#{int(red):02x}{int(green):02x}{int(blue):02x}"
+
+
+def build(image, style, colours, grains):
+    """
+    The vector overlay returned in place of an overlay image.
+    `style` is "outline" (contours stroked, labels drawn) or "fill";
+    `colours` maps each grain class to its BGR colour in the image overlay.
+    """
+    height, width = image.shape[:2]
+    return {
+        "width": width,
+        "height": height,
+        "style": style,
+        "colours": {grain_class: css_colour(bgr) for grain_class, bgr in colours.items()},
+        "grains": grains,
+    }
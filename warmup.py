@@ -0,0 +1,118 @@
+"""
+Startup warm-up for the analyzer.
+
+Opens the camera from a background thread and runs both analysis pipelines
+once on a synthetic tray in every analysis worker, so the first operator action
+after a reboot does not pay for camera start-up, worker start-up, module
+imports and OpenCV's first-call costs. Progress is kept per component and
+exposed through the /ready endpoint.
+"""
+import threading
+import time
+import logging
+
+logger = logging.getLogger('warmup')
+
+# Component states: pending -> warming -> ready | failed
+COMPONENTS = ("camera", "rice_pipeline", "dal_pipeline", "codecs")
+
+_lock = threading.Lock()
+_status = {name: {"state": "pending", "seconds": None, "error": None} for name in COMPONENTS}
+_thread = None
+
+
+def _set_state(name, state, seconds=None, error=None):
+    with _lock:
+        _status[name] = {"state": state, "seconds": seconds, "error": error}
+
+
+def get_status():
+    """Return a snapshot of every component's warm-up state."""
+    with _lock:
+        components = {name: dict(info) for name, info in _status.items()}
+    done = all(info["state"] in ("ready", "failed") for info in components.values())
+    # Uploads can still be analysed without a camera, so it does not gate readiness
+    analysis_ready = all(components[name]["state"] == "ready" for name in COMPONENTS if name != "camera")
+    return {
+        "ready": done and analysis_ready,
+        "done": done,
+        "components": components,
+    }
+
+
+def synthetic_tray(width=640, height=480):
+    """Build a small BGR test frame: pale grains on the blue tray background."""
+    import numpy as np
+    import cv2
+
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[:] = (160, 70, 30)  # Blue tray, inside process_dal's background mask
+    step = 60
+    for y in range(step // 2, height, step):
+        for x in range(step // 2, width, step):
+            cv2.ellipse(frame, (x, y), (18, 8), (x + y) % 180, 0, 360, (215, 225, 230), -1)
+    return frame
+
+
+def _run_step(name, func):
+    _set_state(name, "warming")
+    start = time.monotonic()
+    try:
+        func()
+        elapsed = round(time.monotonic() - start, 3)
+        _set_state(name, "ready", seconds=elapsed)
+        logger.info(f"Warm-up of {name} finished in {elapsed}s")
+    except Exception as e:
+        elapsed = round(time.monotonic() - start, 3)
+        _set_state(name, "failed", seconds=elapsed, error=str(e))
+        logger.warning(f"Warm-up of {name} failed: {e}")
+
+
+def _warm_camera(initialize_camera):
+    cam = initialize_camera()
+    if cam is None:
+        raise RuntimeError("Camera not available")
+    # The first capture allocates the request buffers; do it now, not on /capture
+    if not cam.get_frame():
+        raise RuntimeError("Camera returned no frame data")
+
+
+def _warm_rice():
+    # Analyses run in the job pool, so the worker processes are what needs warming
+    import jobs
+    jobs.warm_pool("rice")
+
+
+def _warm_dal():
+    import jobs
+    jobs.warm_pool("dal")
+
+
+def _warm_codecs():
+    import cv2
+    ok, encoded = cv2.imencode('.jpg', synthetic_tray())
+    if not ok or cv2.imdecode(encoded, cv2.IMREAD_COLOR) is None:
+        raise RuntimeError("JPEG round trip failed")
+
+
+def _warm_all(initialize_camera):
+    # Pipelines first: they only need the CPU, while the camera spends most of
+    # its start-up sleeping.
+    camera_thread = threading.Thread(
+        target=_run_step, args=("camera", lambda: _warm_camera(initialize_camera)), daemon=True)
+    camera_thread.start()
+    _run_step("codecs", _warm_codecs)
+    _run_step("rice_pipeline", _warm_rice)
+    _run_step("dal_pipeline", _warm_dal)
+    camera_thread.join()
+
+
+def start_warmup(initialize_camera):
+    """Start the warm-up in a daemon thread. Safe to call more than once."""
+    global _thread
+    with _lock:
+        if _thread is not None:
+            return _thread
+        _thread = threading.Thread(target=_warm_all, args=(initialize_camera,), daemon=True)
+    _thread.start()
+    return _thread